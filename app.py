@@ -11,7 +11,12 @@ from models.base_model import db
 from models.reply import Reply
 from models.topic import Topic
 from models.user import User
+from models.board import Board
 from routes import current_user
+from routes.assets import init_assets
+from routes.avatar import avatar
+from routes.myredis import model_changed, model_deleted
+from routes.profiler import init_profiler, RequestStatsView
 
 # 注册蓝图
 # url_prefix 给蓝图中的每个路由加一个前缀
@@ -21,9 +26,20 @@ from routes.reply import main as reply_routes
 from routes.mail import main as mail_routes
 from routes.forget import main as forget_routes
 from routes.info import main as info_routes
+from routes.search import main as search_routes
 from routes.user import main as user_routes
 
 
+class CachedModelView(ModelView):
+    """后台修改数据后同步更新 redis 缓存和所有 worker 的进程内缓存"""
+
+    def after_model_change(self, form, model, is_created):
+        model_changed(model)
+
+    def after_model_delete(self, model):
+        model_deleted(model)
+
+
 def count(data):
     return len(data)
 
@@ -60,6 +76,8 @@ def configured_app():
         secret.database_password
     )
     db.init_app(app)
+    init_profiler(app)
+    init_assets(app)
 
     app.register_blueprint(index_routes)
     app.register_blueprint(user_routes)
@@ -68,18 +86,22 @@ def configured_app():
     app.register_blueprint(reply_routes, url_prefix='/reply')
     app.register_blueprint(mail_routes, url_prefix='/mail')
     app.register_blueprint(info_routes, url_prefix='/info')
+    app.register_blueprint(search_routes, url_prefix='/search')
 
     app.template_filter()(count)
     app.template_filter()(format_time)
     app.template_filter()(how_long_ago)
+    app.template_filter()(avatar)
 
     app.template_global()(current_user)
     app.errorhandler(404)(not_found)
 
     admin = Admin(app, name='Swordman BBS')
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Topic, db.session))
-    admin.add_view(ModelView(Reply, db.session))
+    admin.add_view(CachedModelView(User, db.session))
+    admin.add_view(CachedModelView(Board, db.session))
+    admin.add_view(CachedModelView(Topic, db.session))
+    admin.add_view(CachedModelView(Reply, db.session))
+    admin.add_view(RequestStatsView(name='请求统计', endpoint='request_stats'))
 
     return app
 
@@ -0,0 +1,191 @@
+import argparse
+import io
+import json
+import os
+import time
+
+from PIL import Image, ImageOps
+
+from models.base_model import db
+from models.user import User
+from routes.avatar import (avatar_sizes,
+                           avatar_output,
+                           avatar_dir,
+                           avatar_incoming_dir,
+                           legacy_avatar_prefix,
+                           avatar_queue_key,
+                           avatar_processing_key,
+                           avatar_seq_key,
+                           avatar_paths,
+                           check_upload,
+                           submit_avatar,
+                           image_files,
+                           touch_files,
+                           set_user_avatar,
+                           )
+from routes.myredis import redis_client
+from utils import log, log_to_console, write_file_atomic
+
+# 头像的配置和请求中用到的函数在 routes/avatar.py，这里是 worker、migrate 和 gc
+
+avatar_quality = 85
+# 换下来的旧头像不立即删除，由 gc 删除没有用户使用、而且这么多秒内没有被写入或替换的文件。
+# 不能比 redis 中 User 缓存的过期时间短，缓存中旧的 User 还会引用旧头像；
+# 也避免删掉刚处理完、还没写入数据库的头像
+gc_grace_seconds = 86400
+# tasks.py 每隔这么多秒执行一次 gc
+gc_interval = 86400
+# 队列为空时 BRPOPLPUSH 最多阻塞多少秒
+pop_timeout = 5
+
+
+def render_avatar(data):
+    """解码原图，居中裁剪成正方形，返回 {尺寸: 编码后的数据}"""
+    avatar_format, _ = avatar_output()
+    img = Image.open(io.BytesIO(data))
+    largest = max(avatar_sizes.values())
+    # JPEG 可以在解码时直接缩小，大照片解码快很多
+    img.draft('RGB', (largest, largest))
+    # 手机拍的照片方向保存在 EXIF 中
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    if has_alpha and avatar_format == 'JPEG':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+
+    img = ImageOps.fit(img, (largest, largest), Image.LANCZOS)
+    result = {}
+    for name, px in avatar_sizes.items():
+        thumb = img if px == largest else img.resize((px, px), Image.LANCZOS)
+        out = io.BytesIO()
+        thumb.save(out, avatar_format, quality=avatar_quality)
+        result[name] = out.getvalue()
+    return result
+
+
+def is_latest(client, job):
+    """任务是不是用户最近一次上传的头像，旧版本放进队列的任务没有序号，当作最新"""
+    if 'seq' not in job:
+        return True
+    seq = client.get(avatar_seq_key.format(job['user_id']))
+    return seq is None or int(seq) == job['seq']
+
+
+def process_job(client, raw):
+    job = json.loads(raw)
+    if not is_latest(client, job):
+        # 原图不删除，队列中可能还有同一张图片的任务，没有用到的由 gc 清理
+        log('头像已经被之后上传的替换，跳过', raw)
+        return
+
+    digest = job['digest']
+    incoming = os.path.join(avatar_incoming_dir, digest)
+    paths = avatar_paths(digest)
+    # 已经有缩略图时更新修改时间，gc 不会删掉正要使用的文件
+    if not touch_files(paths.values()):
+        with open(incoming, 'rb') as f:
+            data = f.read()
+        os.makedirs(os.path.dirname(paths['profile']), exist_ok=True)
+        for name, out in render_avatar(data).items():
+            write_file_atomic(paths[name], out)
+    # 生成缩略图期间用户可能又上传了头像
+    if is_latest(client, job):
+        set_user_avatar(job['user_id'], digest)
+    try:
+        os.remove(incoming)
+    except FileNotFoundError:
+        pass
+
+
+def recover_processing(client):
+    """worker 启动时，上次处理到一半就退出的头像放回队列重新处理"""
+    while client.rpoplpush(avatar_processing_key, avatar_queue_key) is not None:
+        pass
+
+
+def run_avatar_worker():
+    """处理头像的 worker，由 supervisor 启动，图片解码和压缩不占用 web worker"""
+    from app import configured_app
+    app = configured_app()
+    # 使用阻塞命令，socket_timeout 要比阻塞的时间长。只在 worker 进程中创建，web worker 不需要这个连接池
+    client = redis_client(0, socket_timeout=pop_timeout + 5)
+    with app.app_context():
+        recover_processing(client)
+        while True:
+            raw = client.brpoplpush(avatar_queue_key, avatar_processing_key, timeout=pop_timeout)
+            if raw is None:
+                continue
+            try:
+                process_job(client, raw)
+                log('处理头像', raw)
+            except Exception as e:
+                # 图片损坏等错误重试也不会成功，直接放弃，用户继续使用原来的头像
+                log('处理头像失败', raw, e)
+            finally:
+                db.session.remove()
+            client.lrem(avatar_processing_key, 1, raw)
+
+
+def migrate():
+    """把旧版本上传的原图头像放进队列，由 worker 生成缩略图，旧文件之后由 gc 删除"""
+    n = 0
+    for u in User.query.filter(User.image.startswith(legacy_avatar_prefix)):
+        path = image_files(u.image)[0]
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            check_upload(data)
+        except (OSError, ValueError) as e:
+            log('旧头像无法迁移', u.id, u.image, e)
+            continue
+        submit_avatar(u.id, data)
+        n += 1
+    log('旧头像放入队列', n)
+
+
+def gc():
+    """
+    删除没有用户使用的头像文件和没有处理的原图，只删除 gc_grace_seconds 内没有写入或替换的文件。
+    更换头像时不删除旧头像，由 tasks.py 定期调用这里删除。返回删除的文件数。
+    """
+    deadline = time.time() - gc_grace_seconds
+    used = set()
+    for image, in db.session.query(User.image).filter(User.image.startswith('/images/')):
+        used.update(image_files(image))
+
+    candidates = []
+    for root, _, files in os.walk(avatar_dir):
+        candidates.extend(os.path.join(root, f) for f in files)
+    for root, _, files in os.walk(avatar_incoming_dir):
+        candidates.extend(os.path.join(root, f) for f in files)
+    candidates.extend(os.path.join('images', f) for f in os.listdir('images') if f.startswith('avatar_uid='))
+
+    n = 0
+    for p in candidates:
+        try:
+            if p not in used and os.path.getmtime(p) < deadline:
+                os.remove(p)
+                n += 1
+        except FileNotFoundError:
+            pass
+    log('清理头像文件', n)
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Swordman BBS 头像处理 worker')
+    parser.add_argument('command', nargs='?', choices=['worker', 'migrate', 'gc'], default='worker',
+                        help='worker 处理队列中的头像(默认)；migrate 为旧版本的头像生成缩略图；gc 删除没有使用的头像文件')
+    args = parser.parse_args()
+    if args.command == 'worker':
+        run_avatar_worker()
+    else:
+        log_to_console()
+        from app import configured_app
+        with configured_app().app_context():
+            if args.command == 'migrate':
+                migrate()
+            else:
+                gc()
@@ -0,0 +1,273 @@
+import argparse
+import random
+import time
+from collections import defaultdict
+
+from flask import g
+from sqlalchemy.engine.url import make_url
+
+from app import configured_app
+from models.base_model import db
+from models.board import Board
+from models.info import Info
+from models.message import Messages
+from models.reply import Reply
+from models.topic import Topic
+from models.user import User
+from reset import reset_database
+from routes.myredis import user_identify_cache, views_cache
+from routes.profiler import percentile
+
+# 批量插入时每批的行数
+chunk_size = 5000
+# 压测账号的密码，所有压测用户相同
+bench_password = '123'
+# 压测使用单独的数据库，名字必须包含 bench_database_tag，防止误删线上数据
+bench_database = 'web19_bench'
+bench_database_tag = 'bench'
+# 压测造数据后在 redis 的两个 db 中写入这个 key。
+# redis 中有其他数据却没有这个 key 时认为是线上的 redis，拒绝运行
+bench_redis_marker = 'bench.marker'
+
+
+def bulk_insert(model, rows):
+    """用一条 executemany 的 INSERT 批量插入，rows 是字典的列表"""
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+        rows.clear()
+
+
+def skewed_index(n, skew=3):
+    """
+    返回 [0, n) 中的一个下标，下标越小越容易被选中，
+    用来模拟少数热门用户、热门话题占了大部分回复和浏览的情况。
+    """
+    return int(n * random.random() ** skew)
+
+
+def random_time(start, end):
+    return random.randint(int(start), int(end))
+
+
+def seed(users, topics, replies, messages, infos, heavy_inbox_users):
+    """
+    在 reset.py 建好的空库上批量生成压测数据。
+    回复数按 skewed_index 集中在少数话题上，前 heavy_inbox_users 个用户收到一半的私信和通知。
+    """
+    now = int(time.time())
+    start = now - 365 * 86400
+    password = User.salted_password(bench_password)
+
+    board_ids = [Board.new(dict(title=t)).id for t in ('问答', '资讯', '分享')]
+
+    rows = []
+    for i in range(1, users + 1):
+        t = random_time(start, now)
+        rows.append(dict(
+            id=i,
+            username='bench{}'.format(i),
+            password=password,
+            email='bench{}@example.com'.format(i),
+            created_time=t,
+            updated_time=t,
+        ))
+        if len(rows) >= chunk_size:
+            bulk_insert(User, rows)
+    bulk_insert(User, rows)
+
+    # 先决定每个话题的回复数，再按话题依次生成，话题的 reps、last_rep_、last_active_time 和回复一致
+    reps = [0] * topics
+    for _ in range(replies):
+        reps[skewed_index(topics)] += 1
+
+    topic_rows = []
+    reply_rows = []
+    for i in range(topics):
+        topic_id = i + 1
+        created = random_time(start, now)
+        reply_times = sorted(random_time(created, now) for _ in range(reps[i]))
+        last_rep_uid = -1
+        for t in reply_times:
+            last_rep_uid = skewed_index(users) + 1
+            reply_rows.append(dict(
+                content='压测回复 {}'.format(t),
+                topic_id=topic_id,
+                user_id=last_rep_uid,
+                created_time=t,
+                updated_time=t,
+            ))
+        topic_rows.append(dict(
+            id=topic_id,
+            title='压测话题{}'.format(topic_id),
+            content='压测话题内容 {}'.format(topic_id),
+            user_id=skewed_index(users) + 1,
+            board_id=random.choice(board_ids),
+            views=random.randint(0, 1000),
+            reps=reps[i],
+            last_rep_=last_rep_uid,
+            created_time=created,
+            updated_time=created,
+            last_edit_time=created,
+            last_active_time=reply_times[-1] if reply_times else created,
+        ))
+        if len(topic_rows) >= chunk_size or len(reply_rows) >= chunk_size:
+            bulk_insert(Topic, topic_rows)
+            bulk_insert(Reply, reply_rows)
+    bulk_insert(Topic, topic_rows)
+    bulk_insert(Reply, reply_rows)
+
+    def receiver():
+        if heavy_inbox_users > 0 and random.random() < 0.5:
+            return random.randint(1, heavy_inbox_users)
+        return random.randint(1, users)
+
+    rows = []
+    for _ in range(messages):
+        t = random_time(start, now)
+        rows.append(dict(
+            title='压测私信',
+            content='压测私信内容 {}'.format(t),
+            sender_id=random.randint(1, users),
+            receiver_id=receiver(),
+            been_read=random.random() < 0.8,
+            created_time=t,
+            updated_time=t,
+        ))
+        if len(rows) >= chunk_size:
+            bulk_insert(Messages, rows)
+    bulk_insert(Messages, rows)
+
+    rows = []
+    for _ in range(infos):
+        t = random_time(start, now)
+        rows.append(dict(
+            title='压测通知',
+            content='压测通知内容 {}'.format(t),
+            receiver_id=receiver(),
+            been_read=random.random() < 0.8,
+            created_time=t,
+            updated_time=t,
+        ))
+        if len(rows) >= chunk_size:
+            bulk_insert(Info, rows)
+    bulk_insert(Info, rows)
+
+
+def install_counters(app):
+    """
+    每个请求结束时从 routes.profiler 记在 g.profile 上的统计中取出 SQL 条数和 redis 往返次数，
+    和线上 /admin 统计页面的口径一致
+    """
+    counts = dict(sql=0, redis=0)
+
+    @app.after_request
+    def read_profile(response):
+        p = g.get('profile')
+        if p is not None:
+            counts['sql'] = int(p['sql'])
+            counts['redis'] = int(p['redis'])
+        return response
+
+    return counts
+
+
+def run(app, requests, warmup, users, topics):
+    """
+    用 flask 的 test client 以 bench1 身份访问主要页面，
+    每个路由先预热 warmup 次，再记录 requests 次的耗时、SQL 条数和 redis 往返次数。
+    """
+    counts = install_counters(app)
+    client = app.test_client()
+    client.post('/login', data=dict(username='bench1', password=bench_password))
+
+    routes = [
+        ('/topic', lambda: '/topic/'),
+        ('/topic?board_id', lambda: '/topic/?board_id={}'.format(random.randint(1, 3))),
+        ('/topic/<id>', lambda: '/topic/{}'.format(skewed_index(topics) + 1)),
+        ('/mail/inbox', lambda: '/mail/inbox'),
+        ('/info/', lambda: '/info/'),
+        ('/user/<id>', lambda: '/user/{}'.format(skewed_index(users) + 1)),
+    ]
+    results = defaultdict(lambda: dict(ms=[], sql=[], redis=[]))
+    for name, url in routes:
+        for i in range(warmup + requests):
+            counts['sql'] = counts['redis'] = 0
+            begin = time.perf_counter()
+            r = client.get(url())
+            ms = (time.perf_counter() - begin) * 1000
+            if r.status_code >= 500:
+                raise RuntimeError('{} 返回 {}'.format(name, r.status_code))
+            if i >= warmup:
+                results[name]['ms'].append(ms)
+                results[name]['sql'].append(counts['sql'])
+                results[name]['redis'].append(counts['redis'])
+    return results
+
+
+def report(results):
+    lines = ['{:<18}{:>9}{:>9}{:>9}{:>9}{:>9}{:>9}'.format(
+        'route', 'p50(ms)', 'p90', 'p99', 'max', 'sql', 'redis')]
+    for name, r in results.items():
+        n = len(r['ms'])
+        lines.append('{:<18}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+            name,
+            percentile(r['ms'], 50),
+            percentile(r['ms'], 90),
+            percentile(r['ms'], 99),
+            max(r['ms']),
+            sum(r['sql']) / n,
+            sum(r['redis']) / n,
+        ))
+    return '\n'.join(lines)
+
+
+def check_bench_only(app):
+    """数据库名字不包含 bench，或者 redis 不是空的也不是压测用的，抛出异常"""
+    with app.app_context():
+        database = db.engine.url.database
+    if bench_database_tag not in (database or ''):
+        raise RuntimeError('数据库 {} 不是压测用的数据库，名字需要包含 {}'.format(database, bench_database_tag))
+    for client in (user_identify_cache, views_cache):
+        if client.dbsize() > 0 and not client.exists(bench_redis_marker):
+            raise RuntimeError('redis db {} 中有数据且没有 {}，可能是线上的 redis'.format(
+                client.connection_pool.connection_kwargs['db'], bench_redis_marker))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Swordman BBS 压测：批量造数据，然后统计主要页面的耗时、SQL 和 redis 次数')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--topics', type=int, default=10000)
+    parser.add_argument('--replies', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--infos', type=int, default=20000)
+    parser.add_argument('--heavy-inbox-users', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=200, help='每个路由记录的请求数')
+    parser.add_argument('--warmup', type=int, default=10, help='每个路由预热的请求数')
+    parser.add_argument('--database', default=bench_database, help='压测使用的数据库，名字必须包含 bench')
+    parser.add_argument('--seed', action='store_true', help='删除压测数据库和 redis 中的数据，重新造数据')
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args()
+
+    app = configured_app()
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    url.database = args.database
+    app.config['SQLALCHEMY_DATABASE_URI'] = str(url)
+    check_bench_only(app)
+    if args.seed:
+        with app.app_context():
+            reset_database(args.database)
+            seed(args.users, args.topics, args.replies, args.messages, args.infos, args.heavy_inbox_users)
+        for client in (user_identify_cache, views_cache):
+            client.flushdb()
+            client.set(bench_redis_marker, 1)
+
+    results = run(app, args.requests, args.warmup, args.users, args.topics)
+    s = report(results)
+    print(s)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(s + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+
+from routes.assets import static_dir, build_dir, manifest_path, bundles
+from utils import log, log_to_console, write_file_atomic
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 这些类型的文件额外生成 .gz 和 .br，nginx 的 gzip_static / brotli_static 直接发送，不用每次压缩
+compressible = {'.css', '.js', '.svg', '.json', '.txt'}
+# 文件名中 hash 的长度
+hash_length = 12
+
+
+def source_files():
+    """static 下除了 build 目录以外的所有文件，返回相对 static 的路径"""
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(static_dir) and 'build' in dirs:
+            dirs.remove('build')
+        for f in files:
+            paths.append(os.path.relpath(os.path.join(root, f), static_dir).replace(os.sep, '/'))
+    return sorted(paths)
+
+
+def hashed_name(name, data):
+    """'css/style.css' -> 'style.{hash}.css'"""
+    stem, ext = os.path.splitext(os.path.basename(name))
+    digest = hashlib.sha1(data).hexdigest()[:hash_length]
+    return '{}.{}{}'.format(stem, digest, ext)
+
+
+def write_asset(name, data):
+    """写入 build 目录，返回写入的文件名列表(包括压缩后的文件)，文件已经存在时不重复写"""
+    filename = hashed_name(name, data)
+    written = [filename]
+    path = os.path.join(build_dir, filename)
+    if not os.path.exists(path):
+        write_file_atomic(path, data)
+
+    if os.path.splitext(filename)[1] in compressible:
+        # mtime 固定为 0，同样的内容每次生成同样的 .gz
+        written.append(filename + '.gz')
+        if not os.path.exists(path + '.gz'):
+            write_file_atomic(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            written.append(filename + '.br')
+            if not os.path.exists(path + '.br'):
+                write_file_atomic(path + '.br', brotli.compress(data))
+    return written
+
+
+def read_manifest():
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build():
+    """
+    给 static 下的文件和 bundles 生成带 hash 的文件名，最后写入 manifest。
+    上一次 build 的文件保留，正在运行的旧进程重启前还会引用它们；更早的文件删除。
+    """
+    os.makedirs(build_dir, exist_ok=True)
+    previous = read_manifest()
+
+    new = {}
+    keep = set()
+    contents = {}
+    for name in source_files():
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            contents[name] = f.read()
+        written = write_asset(name, contents[name])
+        new[name] = 'build/' + written[0]
+        keep.update(written)
+
+    for name, members in bundles.items():
+        data = b'\n'.join(contents[m] for m in members)
+        written = write_asset(name, data)
+        new[name] = 'build/' + written[0]
+        keep.update(written)
+
+    for built in previous.values():
+        filename = built[len('build/'):]
+        keep.update([filename, filename + '.gz', filename + '.br'])
+    keep.add(os.path.basename(manifest_path))
+
+    removed = 0
+    for f in os.listdir(build_dir):
+        if f not in keep:
+            os.remove(os.path.join(build_dir, f))
+            removed += 1
+
+    write_file_atomic(manifest_path, json.dumps(new, indent=2, sort_keys=True).encode('utf-8'))
+    log('静态文件 build 完成，文件数', len(new), '删除旧文件', removed, 'brotli', brotli is not None)
+    return new
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Swordman BBS 静态文件 build')
+    parser.add_argument('command', choices=['build'], help='build 生成带 hash 的静态文件、压缩文件和 manifest')
+    parser.parse_args()
+    log_to_console()
+    build()
+
+
+if __name__ == '__main__':
+    main()
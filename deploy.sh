@@ -22,7 +22,7 @@ sysctl -w net.ipv6.conf.all.disable_ipv6=0
 export DEBIAN_FRONTEND=noninteractive
 # 装依赖
 apt-get install -y git supervisor nginx python3-pip mysql-server redis-server
-pip3 install jinja2 flask gevent gunicorn pymysql flask_sqlalchemy flask_mail marrow.mailer redis
+pip3 install jinja2 flask gevent gunicorn pymysql flask_sqlalchemy flask_mail marrow.mailer redis markdown pygments bleach msgpack pillow brotli
 
 
 # 删掉 nginx default 设置
@@ -36,7 +36,15 @@ cp /var/www/web_bbs/web.conf /etc/supervisor/conf.d/web.conf
 
 # 初始化
 cd /var/www/web_bbs
+python3 build_assets.py build
 python3 reset.py
+# 每次更新代码后都要执行 python3 build_assets.py build 再重启，页面才会引用新的静态文件
+# 已有数据时不要执行 reset.py，用 python3 migrate.py 补上新的表和索引
+# 升级时执行一次 python3 session_tool.py compact，把旧格式的登录会话迁移成带 TTL 的 hash
+# 第一次上线全文搜索时执行一次 python3 search_index.py reindex，之后发帖、回帖时自动增量更新
+# 搜索索引从 (term, doc_id) 改成了 (term, tf)，migrate.py 建好新索引后可以执行 DROP INDEX ix_search_posting_term_doc ON search_posting
+# search_posting 加了 board_id 列、新增了 search_term 表，migrate.py 之后执行一次 python3 search_index.py reindex 填好它们
+# 升级时执行一次 python3 avatar_queue.py migrate，为旧版本上传的头像生成缩略图；换下来的旧头像由 tasks.py 每天执行一次 gc 删除
 
 # 重启服务器
 service supervisor restart
@@ -0,0 +1,119 @@
+import argparse
+import json
+import re
+import time
+
+import models.message
+from models.message import send_mail, reset_mailer
+from routes.myredis import user_identify_cache, redis_client
+from utils import log
+
+# 待发送的邮件，请求中 LPUSH，worker BRPOPLPUSH 到 processing 中发送，发完后从 processing 删除
+mail_queue_key = 'mail_queue'
+mail_processing_key = 'mail_queue.processing'
+# 发送失败等待重试的邮件，zset 的 score 是下次重试的时间
+mail_retry_key = 'mail_queue.retry'
+# 重试多次仍然失败的邮件，留给人工处理
+mail_dead_key = 'mail_queue.dead'
+
+max_attempts = 5
+# 第 n 次失败后等待 retry_base_delay * 2 ** (n - 1) 秒再重试
+retry_base_delay = 30
+# 一次最多连续发送的邮件数，发完一批再检查需要重试的邮件
+batch_size = 20
+# 队列为空时 BRPOPLPUSH 最多阻塞多少秒
+pop_timeout = 5
+
+# worker 使用阻塞命令，socket_timeout 要比阻塞的时间长
+worker_cache = redis_client(0, socket_timeout=pop_timeout + 5)
+
+_address_pattern = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def enqueue_mail(subject, author, to, content):
+    """
+    把邮件放进发送队列后立即返回，由 mail_queue.py 的 worker 进程发送。
+    邮箱格式错误时抛出 ValueError，和原来同步发送时一样由调用方处理。
+    """
+    if _address_pattern.match(to) is None:
+        raise ValueError('邮箱格式错误: {}'.format(to))
+    job = dict(
+        subject=subject,
+        author=author,
+        to=to,
+        content=content,
+        attempts=0,
+    )
+    user_identify_cache.lpush(mail_queue_key, json.dumps(job))
+
+
+def requeue_due_retries():
+    """把已经到重试时间的邮件放回发送队列"""
+    now = time.time()
+    for raw in worker_cache.zrangebyscore(mail_retry_key, 0, now):
+        # zrem 成功的 worker 才负责放回，避免重复发送
+        if worker_cache.zrem(mail_retry_key, raw):
+            worker_cache.lpush(mail_queue_key, raw)
+
+
+def recover_processing():
+    """worker 启动时，上次发送到一半就退出的邮件放回队列重新发送"""
+    while worker_cache.rpoplpush(mail_processing_key, mail_queue_key) is not None:
+        pass
+
+
+def handle_failure(raw, e):
+    job = json.loads(raw)
+    job['attempts'] += 1
+    job['error'] = str(e)
+    if job['attempts'] >= max_attempts:
+        worker_cache.lpush(mail_dead_key, json.dumps(job))
+        log('邮件发送失败，放弃', job['to'], e)
+    else:
+        delay = retry_base_delay * 2 ** (job['attempts'] - 1)
+        worker_cache.zadd(mail_retry_key, {json.dumps(job): time.time() + delay})
+        log('邮件发送失败，{}秒后重试'.format(delay), job['to'], e)
+
+
+def send_batch():
+    """从队列中取出最多 batch_size 封邮件，复用同一个 SMTP 连接发送，返回处理的邮件数"""
+    n = 0
+    raw = worker_cache.brpoplpush(mail_queue_key, mail_processing_key, timeout=pop_timeout)
+    while raw is not None:
+        job = json.loads(raw)
+        try:
+            send_mail(
+                subject=job['subject'],
+                author=job['author'],
+                to=job['to'],
+                content=job['content'],
+            )
+        except Exception as e:
+            # 连接可能已经不可用，下一封邮件重新连接
+            reset_mailer()
+            handle_failure(raw, e)
+        worker_cache.lrem(mail_processing_key, 1, raw)
+
+        n += 1
+        if n >= batch_size:
+            break
+        raw = worker_cache.rpoplpush(mail_queue_key, mail_processing_key)
+    return n
+
+
+def run_mail_worker():
+    """发送邮件的 worker，由 supervisor 启动，只运行一个进程"""
+    recover_processing()
+    while True:
+        requeue_due_retries()
+        n = send_batch()
+        if n > 0:
+            log('发送邮件', n)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Swordman BBS 邮件发送 worker')
+    parser.add_argument('--debug-smtp', help='本地调试用的 SMTP 服务器 host:port，例如 localhost:1025')
+    args = parser.parse_args()
+    models.message.debug_smtp = args.debug_smtp
+    run_mail_worker()
@@ -0,0 +1,91 @@
+from sqlalchemy import create_engine, inspect, bindparam
+from sqlalchemy.schema import CreateColumn
+
+import secret
+from models.base_model import db
+# 导入所有 model，让 db.metadata 中包含所有的表
+from models.board import Board
+from models.topic import Topic
+from models.user import User
+from models.reply import Reply
+from models.message import Messages
+from models.info import Info
+from models.search import SearchDoc, SearchPosting, SearchTerm
+from utils import log, log_to_console
+
+# 回填 mentions 时每批处理的行数
+backfill_chunk_size = 1000
+
+
+def migrate_database():
+    """
+    把 model 中新增的表、列和索引同步到正在使用的数据库，不删除任何数据。
+    新增的列只能是允许为 NULL 或者有默认值的列。
+    reset.py 会删库重建，线上已有数据时用这个脚本。
+    InnoDB 建索引是 online DDL，建索引期间表仍然可以读写。
+    """
+    url = 'mysql+pymysql://root:{}@localhost/web19?charset=utf8mb4'.format(
+        secret.database_password
+    )
+    e = create_engine(url, echo=True)
+
+    # 只创建还不存在的表
+    db.metadata.create_all(bind=e)
+
+    inspector = inspect(e)
+    for table in db.metadata.sorted_tables:
+        columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                log('添加列', table.name, column.name)
+                ddl = CreateColumn(column).compile(dialect=e.dialect)
+                with e.connect() as c:
+                    name = e.dialect.identifier_preparer.quote(table.name)
+                    c.execute('ALTER TABLE {} ADD COLUMN {}'.format(name, ddl))
+
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                log('创建索引', table.name, index.name)
+                index.create(bind=e)
+
+
+def backfill_mentions():
+    """
+    mentions 列加上之前发表的话题和回复没有解析好的 @ 用户，渲染时每条都要查一次数据库。
+    这里一次性解析并写回，之后渲染不再查询。已经回填的行 mentions 不为 NULL，可以重复执行。
+    """
+    from app import configured_app
+    from routes import at_users, mentions_json
+    from routes.myredis import delete_cached_models
+
+    app = configured_app()
+    with app.app_context():
+        for model in (Topic, Reply):
+            n = 0
+            while True:
+                rows = db.session.query(model.id, model.content) \
+                    .filter(model.mentions.is_(None)) \
+                    .order_by(model.id) \
+                    .limit(backfill_chunk_size) \
+                    .all()
+                if not rows:
+                    break
+                values = [dict(_id=i, mentions=mentions_json(at_users(content))) for i, content in rows]
+                db.session.execute(
+                    model.__table__.update()
+                    .where(model.__table__.c.id == bindparam('_id'))
+                    .values(mentions=bindparam('mentions')),
+                    values,
+                )
+                db.session.commit()
+                # redis 中缓存的对象还是 mentions 为 NULL 的版本
+                delete_cached_models(model, [i for i, _ in rows])
+                n += len(rows)
+            log('回填 mentions', model.__name__, n)
+
+
+if __name__ == '__main__':
+    log_to_console()
+    migrate_database()
+    backfill_mentions()
@@ -21,6 +21,13 @@ class SQLMixin(object):
 
         return m
 
+    @classmethod
+    def bulk_new(cls, forms):
+        """批量新建多条记录，forms 是字典的列表，一条 executemany 的 INSERT，一次 commit"""
+        if forms:
+            db.session.bulk_insert_mappings(cls, forms)
+            db.session.commit()
+
     @classmethod
     def get_model(cls, form):
         m = cls()
@@ -39,6 +46,7 @@ class SQLMixin(object):
             setattr(m, name, value)
 
         m.save()
+        return m
 
     @classmethod
     def all(cls, **kwargs):
@@ -88,6 +96,33 @@ class SQLMixin(object):
         db.session.delete(item)
         db.session.commit()
 
+    @classmethod
+    def _locked_ids(cls, **kwargs):
+        # MySQL 的 UPDATE / DELETE 没有 RETURNING，先在同一个事务里锁住并查出满足条件的 id
+        return [i for i, in db.session.query(cls.id).filter_by(**kwargs).with_for_update()]
+
+    @classmethod
+    def bulk_update(cls, values, **kwargs):
+        """
+        把 filter_by(**kwargs) 选中的所有行更新为 values，一条 UPDATE，一次 commit。
+        返回被更新的 id 列表，用来清理对应的缓存。
+        Messages.bulk_update(dict(been_read=True), receiver_id=1, been_read=False)
+        """
+        ids = cls._locked_ids(**kwargs)
+        if ids:
+            cls.query.filter(cls.id.in_(ids)).update(values, synchronize_session=False)
+        db.session.commit()
+        return ids
+
+    @classmethod
+    def bulk_delete(cls, **kwargs):
+        """删除 filter_by(**kwargs) 选中的所有行，一条 DELETE，一次 commit，返回被删除的 id 列表"""
+        ids = cls._locked_ids(**kwargs)
+        if ids:
+            cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        return ids
+
     def json(self):
         d = dict()
         for attr, column in self.columns():
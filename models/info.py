@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Unicode, UnicodeText, Integer, Boolean
+from sqlalchemy import Column, Unicode, UnicodeText, Integer, Boolean, Index
 
 from models.base_model import SQLMixin, db
 
@@ -9,6 +9,10 @@ class Info(SQLMixin, db.Model):
     receiver_id = Column(Integer, nullable=False)
     been_read = Column(Boolean, nullable=False, default=False)
 
+    __table_args__ = (
+        Index('ix_info_receiver_read_created', 'receiver_id', 'been_read', 'created_time'),
+    )
+
     @staticmethod
     def send(title: str, content: str, receiver_id: int):
         form = dict(
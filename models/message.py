@@ -1,5 +1,5 @@
 from marrow.mailer import Mailer
-from sqlalchemy import Column, Unicode, UnicodeText, Integer, Boolean
+from sqlalchemy import Column, Unicode, UnicodeText, Integer, Boolean, Index
 
 from config import admin_mail
 import secret
@@ -10,11 +10,16 @@ from models.user import User
 # from tasks import send_async, mailer
 
 
+# 本地调试时设为 'host:port'，邮件发到不需要登录的本地 SMTP 服务器，
+# 例如 python -m aiosmtpd -n -l localhost:1025
+debug_smtp = None
+
+
 def configured_mailer():
     config = {
         # 'manager.use': 'futures',
         'transport.debug': True,
-        'transport.timeout': 1,
+        'transport.timeout': 10,
         'transport.use': 'smtp',
         'transport.host': 'smtp.exmail.qq.com',
         'transport.port': 465,
@@ -22,24 +27,52 @@ def configured_mailer():
         'transport.username': admin_mail,
         'transport.password': secret.mail_password,
     }
+    if debug_smtp is not None:
+        host, port = debug_smtp.split(':')
+        config.update({
+            'transport.host': host,
+            'transport.port': int(port),
+            'transport.tls': '',
+            'transport.username': None,
+            'transport.password': None,
+        })
     m = Mailer(config)
     m.start()
     return m
 
 
-mailer = configured_mailer()
+# 邮件只由 mail_queue.py 的 worker 进程发送，mailer 在第一次发信时才连接，不拖慢 web worker 启动
+mailer = None
+
+
+def get_mailer():
+    global mailer
+    if mailer is None:
+        mailer = configured_mailer()
+    return mailer
+
+
+def reset_mailer():
+    """发信出错后丢弃当前连接，下次发信时重新连接"""
+    global mailer
+    if mailer is not None:
+        try:
+            mailer.stop()
+        finally:
+            mailer = None
 
 
 def send_mail(subject, author, to, content):
-    m = mailer.new(
+    """同步发送一封邮件，同一个进程中复用 SMTP 连接。请求中不要直接调用，用 mail_queue.enqueue_mail"""
+    m = get_mailer()
+    message = m.new(
         subject=subject,
         author=author,
         to=to,
     )
-    m.plain = content
+    message.plain = content
 
-    mailer.send(m)
-    # sleep(30)
+    m.send(message)
 
 
 class Messages(SQLMixin, db.Model):
@@ -49,6 +82,11 @@ class Messages(SQLMixin, db.Model):
     receiver_id = Column(Integer, nullable=False)
     been_read = Column(Boolean, nullable=False, default=False)
 
+    __table_args__ = (
+        Index('ix_messages_receiver_read_created', 'receiver_id', 'been_read', 'created_time'),
+        Index('ix_messages_sender_created', 'sender_id', 'created_time'),
+    )
+
     @staticmethod
     def send(title: str, content: str, sender_id: int, receiver_id: int):
         form = dict(
@@ -58,7 +96,7 @@ class Messages(SQLMixin, db.Model):
             receiver_id=receiver_id
         )
 
-        Messages.new(form)
+        m = Messages.new(form)
 
         # receiver: User = User.one(id=receiver_id)
         # send_mail(
@@ -93,3 +131,5 @@ class Messages(SQLMixin, db.Model):
         #     to=receiver.email,
         #     plain=form['content']
         # )
+
+        return m
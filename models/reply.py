@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, UnicodeText
+from sqlalchemy import Column, Integer, UnicodeText, Index
 
 from models.base_model import db, SQLMixin
 from models.user import User
@@ -9,6 +9,13 @@ class Reply(SQLMixin, db.Model):
     content = Column(UnicodeText, nullable=False)
     topic_id = Column(Integer, nullable=False)
     user_id = Column(Integer, nullable=False)
+    # 发表时解析好的 @ 用户，json 格式的 {用户名: user id}，为 None 的是还没解析过的老数据
+    mentions = Column(UnicodeText)
+
+    __table_args__ = (
+        Index('ix_reply_topic_created', 'topic_id', 'created_time'),
+        Index('ix_reply_user_created', 'user_id', 'created_time'),
+    )
 
     def user(self):
         u = User.one(id=self.user_id)
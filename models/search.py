@@ -0,0 +1,239 @@
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+
+from sqlalchemy import Column, Integer, Unicode, Index, func
+from sqlalchemy.dialects import mysql
+
+from models.base_model import SQLMixin, db
+
+# 一个词项最多保存的字符数
+max_term_length = 20
+# 搜索时最多使用的词项个数，太长的查询截断
+max_query_terms = 16
+# 标题中的词项按出现次数的这么多倍计算，标题命中比正文命中更重要
+title_weight = 3
+# 出现在超过这个比例的文档中的词项(例如 '我们'、'the')区分度很低，查询时跳过。
+# 文档数不超过 max_postings_per_term 的词项一次就能取完，不跳过
+max_df_ratio = 0.2
+# 每个词项最多取 tf 最高的这么多条倒排记录参与打分，查询的开销不随数据量增长
+max_postings_per_term = 2000
+# BM25 的参数
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+kind_topic = 1
+kind_reply = 2
+
+# 中日韩文字，按字切分成二元组；其他连续的字母数字当作一个词
+_cjk = '㐀-䶿一-鿿豈-﫿'
+_token_pattern = re.compile('([{0}]+)|([^\\W_{0}]+)'.format(_cjk))
+
+
+def tokenize(text):
+    """
+    切分成词项的列表。
+    中文没有空格分词，连续的汉字切成相邻两个字的二元组(n-gram)，例如 '数据库' 切成 '数据'、'据库'，
+    只有一个字时保留这个字。英文和数字按单词切分，转成小写。
+    """
+    terms = []
+    for cjk, word in _token_pattern.findall(text or ''):
+        if cjk:
+            if len(cjk) == 1:
+                terms.append(cjk)
+            else:
+                terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            terms.append(word.lower()[:max_term_length])
+    return terms
+
+
+class SearchDoc(SQLMixin, db.Model):
+    """
+    全文检索中的一个文档，对应一个话题(标题和正文)或者一条回复。
+    topic_id 和 board_id 冗余保存，用来按话题合并结果和按板块过滤。
+    """
+    kind = Column(Integer, nullable=False)
+    item_id = Column(Integer, nullable=False)
+    topic_id = Column(Integer, nullable=False)
+    board_id = Column(Integer, nullable=False)
+    # 文档的词项总数，BM25 按文档长度归一化
+    length = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_search_doc_item', 'kind', 'item_id', unique=True),
+        Index('ix_search_doc_topic', 'topic_id'),
+    )
+
+    @staticmethod
+    def topic_terms(topic):
+        return tokenize(topic.title) * title_weight + tokenize(topic.content)
+
+    @staticmethod
+    def reply_terms(reply):
+        return tokenize(reply.content)
+
+    @staticmethod
+    def posting_rows(doc_id, board_id, terms):
+        """一个文档的倒排记录，批量插入用"""
+        return [dict(term=t, doc_id=doc_id, board_id=board_id, tf=n) for t, n in Counter(terms).items()]
+
+    @classmethod
+    def _add(cls, kind, item_id, topic_id, board_id, terms):
+        """新增一个文档和它的倒排记录，不 commit"""
+        doc = cls(kind=kind, item_id=item_id, topic_id=topic_id, board_id=board_id, length=len(terms))
+        db.session.add(doc)
+        db.session.flush()
+        rows = cls.posting_rows(doc.id, board_id, terms)
+        if rows:
+            db.session.execute(SearchPosting.__table__.insert(), rows)
+            SearchTerm.change_df({r['term']: 1 for r in rows})
+
+    @classmethod
+    def _remove(cls, doc_ids):
+        """删除文档和它们的倒排记录，不 commit"""
+        if doc_ids:
+            rows = db.session.query(SearchPosting.term, func.count()) \
+                .filter(SearchPosting.doc_id.in_(doc_ids)) \
+                .group_by(SearchPosting.term)
+            SearchTerm.change_df({t: -n for t, n in rows})
+            SearchPosting.query.filter(SearchPosting.doc_id.in_(doc_ids)).delete(synchronize_session=False)
+            cls.query.filter(cls.id.in_(doc_ids)).delete(synchronize_session=False)
+
+    @classmethod
+    def index_topic(cls, topic):
+        """发表或修改话题后调用，重新建立话题的索引，修改了板块时同步更新回复的文档和倒排记录的 board_id"""
+        old = db.session.query(cls.id, cls.board_id).filter_by(kind=kind_topic, item_id=topic.id).all()
+        cls._remove([i for i, _ in old])
+        cls._add(kind_topic, topic.id, topic.id, topic.board_id, cls.topic_terms(topic))
+        if old and old[0].board_id != topic.board_id:
+            ids = [i for i, in db.session.query(cls.id).filter_by(topic_id=topic.id)]
+            values = dict(board_id=topic.board_id)
+            cls.query.filter(cls.id.in_(ids)).update(values, synchronize_session=False)
+            SearchPosting.query.filter(SearchPosting.doc_id.in_(ids)).update(values, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def index_reply(cls, reply, board_id):
+        """发表回复后调用"""
+        cls._add(kind_reply, reply.id, reply.topic_id, board_id, cls.reply_terms(reply))
+        db.session.commit()
+
+    @classmethod
+    def remove_reply(cls, reply_id):
+        ids = [i for i, in db.session.query(cls.id).filter_by(kind=kind_reply, item_id=reply_id)]
+        cls._remove(ids)
+        db.session.commit()
+
+    @classmethod
+    def remove_topic(cls, topic_id):
+        """删除话题后调用，话题和它所有回复的文档一起删除"""
+        ids = [i for i, in db.session.query(cls.id).filter_by(topic_id=topic_id)]
+        cls._remove(ids)
+        db.session.commit()
+
+    @classmethod
+    def corpus_stats(cls):
+        """返回 (文档总数, 文档平均长度)，BM25 打分要用，需要扫描整个表，调用方应该缓存"""
+        total_docs, avg_length = db.session.query(func.count(cls.id), func.avg(cls.length)).one()
+        return total_docs, float(avg_length or 0) or 1.0
+
+    @classmethod
+    def search(cls, query, board_id=-1, page=1, n=20, stats=None):
+        """
+        用 BM25 给文档打分，同一个话题的多个文档(话题本身和回复)取最高分，按分数从高到低排序。
+        board_id 为 -1 时不限板块。返回 (本页的 topic id 列表, 命中的话题总数)。
+        stats 是 corpus_stats() 的结果，不传时现场查询。
+        太常见的词项跳过，每个词项只取 tf 最高的 max_postings_per_term 条记录，
+        所以命中总数是近似值，换来每次查询的开销有上限。
+        """
+        terms = list(dict.fromkeys(tokenize(query)))[:max_query_terms]
+        if not terms:
+            return [], 0
+
+        total_docs, avg_length = stats or cls.corpus_stats()
+        if not total_docs:
+            return [], 0
+
+        # 每个词项出现在多少个文档中，一次查询 search_term 表，不用统计倒排记录
+        counts = SearchTerm.df_of(terms)
+        df = {t: counts[t] for t in terms if counts.get(t, 0) > 0}
+        common = max(total_docs * max_df_ratio, max_postings_per_term)
+        rare = {t: d for t, d in df.items() if d <= common}
+        if rare:
+            df = rare
+        elif df:
+            # 查询中全部是常见词项时只用第一个
+            t = next(iter(df))
+            df = {t: df[t]}
+        idf = {t: math.log(1 + (total_docs - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+
+        doc_scores = defaultdict(float)
+        doc_topics = {}
+        for term in df:
+            q = db.session.query(SearchPosting.doc_id, SearchPosting.tf, cls.length, cls.topic_id) \
+                .join(cls, cls.id == SearchPosting.doc_id) \
+                .filter(SearchPosting.term == term)
+            if board_id != -1:
+                # 按倒排记录上冗余的 board_id 过滤，走 (term, board_id, tf) 索引，不用先取出再 join 过滤
+                q = q.filter(SearchPosting.board_id == board_id)
+            q = q.order_by(SearchPosting.tf.desc()).limit(max_postings_per_term)
+            for doc_id, tf, length, topic_id in q:
+                norm = bm25_k1 * (1 - bm25_b + bm25_b * length / avg_length)
+                doc_scores[doc_id] += idf[term] * tf * (bm25_k1 + 1) / (tf + norm)
+                doc_topics[doc_id] = topic_id
+
+        topic_scores = defaultdict(float)
+        for doc_id, score in doc_scores.items():
+            topic_id = doc_topics[doc_id]
+            topic_scores[topic_id] = max(topic_scores[topic_id], score)
+
+        start = (page - 1) * n
+        ranked = heapq.nsmallest(start + n, topic_scores, key=lambda t: (-topic_scores[t], -t))
+        return ranked[start:], len(topic_scores)
+
+
+class SearchPosting(SQLMixin, db.Model):
+    """倒排索引，词项 term 在文档 doc_id 中出现了 tf 次，board_id 和文档的一致"""
+    # 区分大小写和全角半角，不同的词项不能被 MySQL 的排序规则当成同一个
+    term = Column(Unicode(max_term_length, collation='utf8mb4_bin'), nullable=False)
+    doc_id = Column(Integer, nullable=False)
+    board_id = Column(Integer, nullable=False)
+    tf = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # 按词项取 tf 最高的记录，不用排序
+        Index('ix_search_posting_term_tf', 'term', 'tf'),
+        # 限定板块时按词项和板块取 tf 最高的记录
+        Index('ix_search_posting_term_board_tf', 'term', 'board_id', 'tf'),
+        Index('ix_search_posting_doc', 'doc_id'),
+    )
+
+
+class SearchTerm(SQLMixin, db.Model):
+    """词项 term 出现在 df 个文档中，增删文档时和倒排记录一起更新，查询时不用统计倒排记录"""
+    term = Column(Unicode(max_term_length, collation='utf8mb4_bin'), nullable=False)
+    df = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_search_term_term', 'term', unique=True),
+    )
+
+    @classmethod
+    def change_df(cls, changes):
+        """
+        changes 是 {词项: 文档数的变化}，不 commit。
+        按词项排序后写入，多个请求同时修改同一批词项时加锁的顺序一致，不会死锁。
+        """
+        rows = [dict(term=t, df=d) for t, d in sorted(changes.items()) if d]
+        if rows:
+            stmt = mysql.insert(cls.__table__)
+            stmt = stmt.on_duplicate_key_update(df=cls.__table__.c.df + stmt.inserted.df)
+            db.session.execute(stmt, rows)
+
+    @classmethod
+    def df_of(cls, terms):
+        """{词项: 文档数}，没有出现过的词项不在结果中"""
+        rows = db.session.query(cls.term, cls.df).filter(cls.term.in_(terms))
+        return {t: d for t, d in rows}
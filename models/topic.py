@@ -1,6 +1,6 @@
 import time
 
-from sqlalchemy import String, Integer, Column, Text, UnicodeText, Unicode
+from sqlalchemy import String, Integer, Column, Text, UnicodeText, Unicode, Index, or_, and_, desc, func, bindparam
 
 from models import Model
 from models.base_model import SQLMixin, db
@@ -18,6 +18,15 @@ class Topic(SQLMixin, db.Model):
     board_id = Column(Integer, nullable=False)
     reps = Column(Integer, nullable=False, default=0)
     last_rep_ = Column(Integer, nullable=False, default=-1)
+    # 发表时解析好的 @ 用户，json 格式的 {用户名: user id}，为 None 的是还没解析过的老数据
+    mentions = Column(UnicodeText)
+
+    # 话题列表按 (last_active_time, id) 倒序做 keyset 分页，全部和分板块各一个复合索引
+    __table_args__ = (
+        Index('ix_topic_active', 'last_active_time', 'id'),
+        Index('ix_topic_board_active', 'board_id', 'last_active_time', 'id'),
+        Index('ix_topic_user_active', 'user_id', 'last_active_time'),
+    )
 
     @classmethod
     def add(cls, form, user_id):
@@ -27,11 +36,102 @@ class Topic(SQLMixin, db.Model):
 
     @classmethod
     def get(cls, id):
-        m = cls.one(id=id)
-        if m is not None:
-            m.views += 1
-            m.save()
-            return m
+        return cls.one(id=id)
+
+    @classmethod
+    def add_views(cls, views):
+        """
+        views 是 {topic_id: 新增浏览数}，用一条 executemany 的 UPDATE 在一个事务里批量累加。
+        浏览数平时记在 redis 里，由 tasks.py 定期调用这里写回数据库。
+        """
+        if not views:
+            return
+        stmt = cls.__table__.update().where(cls.id == bindparam('topic_id')).values(
+            views=cls.views + bindparam('n'))
+        db.session.execute(stmt, [dict(topic_id=k, n=v) for k, v in views.items()])
+        db.session.commit()
+
+    @classmethod
+    def page(cls, board_id=-1, cursor=None, n=30):
+        """
+        按 (last_active_time, id) 倒序分页，board_id 为 -1 时不限板块。
+        cursor 是上一页最后一个话题的 (last_active_time, id)，None 表示第一页。
+        返回本页的话题列表和下一页的 cursor，没有下一页时 cursor 为 None。
+        """
+        q = db.session.query(cls)
+        if board_id != -1:
+            q = q.filter_by(board_id=board_id)
+        if cursor is not None:
+            active_time, topic_id = cursor
+            q = q.filter(or_(cls.last_active_time < active_time,
+                             and_(cls.last_active_time == active_time, cls.id < topic_id)))
+        # 多取一条用来判断是否还有下一页
+        q = q.order_by(desc(cls.last_active_time), desc(cls.id)).limit(n + 1)
+        ts = list(q)
+        next_cursor = None
+        if len(ts) > n:
+            ts = ts[:n]
+            last = ts[-1]
+            next_cursor = (last.last_active_time, last.id)
+        return ts, next_cursor
+
+    @classmethod
+    def last_repliers(cls, topics):
+        """
+        批量得到多个话题最后回复人的 user id，返回 {topic_id: user_id}，没有回复的话题不在其中。
+        维护了 last_rep_ 的话题直接使用；老数据里有回复却没有 last_rep_ 的话题，
+        用一条查询取出每个话题 id 最大的回复。
+        """
+        repliers = {t.id: t.last_rep_ for t in topics if t.last_rep_ != -1}
+        missing = [t.id for t in topics if t.last_rep_ == -1 and t.reps > 0]
+        if missing:
+            newest = db.session.query(func.max(Reply.id)).filter(
+                Reply.topic_id.in_(missing)).group_by(Reply.topic_id)
+            rows = db.session.query(Reply.topic_id, Reply.user_id).filter(Reply.id.in_(newest))
+            for topic_id, user_id in rows:
+                repliers[topic_id] = user_id
+        return repliers
+
+    @classmethod
+    def add_reply(cls, form):
+        """
+        新增回复，在同一个事务中用一条 UPDATE 原子地更新话题的回复数、最后活跃时间和最后回复人，
+        并发回复时不会丢失更新。返回新的 Reply。
+        """
+        r = Reply()
+        for name, value in form.items():
+            setattr(r, name, value)
+        now = time.time()
+        r.created_time = now
+        r.updated_time = now
+        db.session.add(r)
+        db.session.query(cls).filter_by(id=r.topic_id).update({
+            cls.reps: cls.reps + 1,
+            cls.last_active_time: func.greatest(cls.last_active_time, now),
+            cls.last_rep_: r.user_id,
+        }, synchronize_session=False)
+        db.session.commit()
+        return r
+
+    @classmethod
+    def remove_reply(cls, r):
+        """
+        删除回复，在同一个事务中用一条 UPDATE 原子地减少回复数，
+        并用剩下最新的回复更新最后活跃时间和最后回复人，没有回复时恢复为话题本身。
+        """
+        topic_id = r.topic_id
+        db.session.delete(r)
+        db.session.flush()
+        newest = db.session.query(Reply).filter_by(topic_id=topic_id).order_by(
+            desc(Reply.created_time), desc(Reply.id)).limit(1)
+        newest_time = newest.with_entities(Reply.created_time).as_scalar()
+        newest_uid = newest.with_entities(Reply.user_id).as_scalar()
+        db.session.query(cls).filter_by(id=topic_id).update({
+            cls.reps: cls.reps - 1,
+            cls.last_active_time: func.coalesce(newest_time, cls.created_time),
+            cls.last_rep_: func.coalesce(newest_uid, -1),
+        }, synchronize_session=False)
+        db.session.commit()
 
     def last_reply(self):
         r = Reply.newest_n(1, topic_id=self.id)
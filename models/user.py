@@ -11,10 +11,10 @@ class User(SQLMixin, db.Model):
      用户名 和 用户密码
      用户头像uri 和 用户邮箱
     """
-    username = Column(String(50), nullable=False)
+    username = Column(String(50), nullable=False, index=True)
     password = Column(String(256), nullable=False)
     image = Column(String(100), nullable=False, default='/images/default_profile.jpg')
-    email = Column(String(50), nullable=False, default=config.test_mail)
+    email = Column(String(50), nullable=False, default=config.test_mail, index=True)
     signature = Column(String(256), nullable=False, default='该用户太懒,什么也没有写。')
 
     @classmethod
@@ -1,4 +1,3 @@
-import redis
 from sqlalchemy import create_engine
 
 import secret
@@ -10,18 +9,21 @@ from models.user import User
 from models.reply import Reply
 from models.message import Messages
 from models.info import Info
+from models.search import SearchDoc, SearchPosting, SearchTerm
+from routes.myredis import redis_client
+from search_index import reindex
 
 
-def reset_database():
+def reset_database(database='web19'):
     url = 'mysql+pymysql://root:{}@localhost/?charset=utf8mb4'.format(
         secret.database_password
     )
     e = create_engine(url, echo=True)
 
     with e.connect() as c:
-        c.execute('DROP DATABASE IF EXISTS web19')
-        c.execute('CREATE DATABASE web19 CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci')
-        c.execute('USE web19')
+        c.execute('DROP DATABASE IF EXISTS {}'.format(database))
+        c.execute('CREATE DATABASE {} CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci'.format(database))
+        c.execute('USE {}'.format(database))
 
     db.metadata.create_all(bind=e)
 
@@ -86,9 +88,10 @@ if __name__ == '__main__':
     with app.app_context():
         reset_database()
         generate_fake_date()
+        reindex()
 
-    cache1 = redis.StrictRedis()
+    cache1 = redis_client(0)
     cache1.flushdb()
 
-    cache2 = redis.StrictRedis(db=1)
+    cache2 = redis_client(1)
     cache2.flushdb()
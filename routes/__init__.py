@@ -1,67 +1,132 @@
+import hashlib
+import hmac
 import json
-import uuid
+import os
+import time
+from collections import Counter
 from functools import wraps
 
-from flask import (request,
+from flask import (current_app,
+                   request,
                    abort,
                    redirect,
                    flash,
+                   g,
                    )
 
 from config import web_domain_name
 from models.info import Info
 from models.reply import Reply
-from models.session import ServerSession
 from models.topic import Topic
 from models.user import User
 
 from routes.myredis import (user_identify_cache,
                             cached_topic_id2topic,
                             cached_reply_id2reply,
-                            cached_user_id2user, data_cache, )
+                            cached_user_id2user,
+                            cached_user_ids2users,
+                            incr_unread,
+                            delete_cached_list,
+                            data_cache, )
+from routes.session_store import session_user_id
 
 
 def current_user():
+    """
+    返回当前登录的用户，未登录返回 None。
+    一个请求里会被装饰器、路由、模板多次调用，结果保存在 flask.g 中，每个请求只查一次 redis。
+    """
+    if 'current_user' not in g:
+        g.current_user = load_current_user()
+    return g.current_user
 
-    session_id = request.cookies.get('session_id')
-    key = 'session_id.{}'.format(session_id)
 
-    if session_id is not None and user_identify_cache.exists(key):
-        session_json = user_identify_cache.get(key)
-        session_dict = json.loads(session_json)
-        my_session = ServerSession(session_dict)
+def forget_current_user():
+    """注销、修改资料、修改头像之后调用，本请求中下次 current_user 会重新读取"""
+    g.pop('current_user', None)
+
 
-        if not my_session.expired():
-            user_id = my_session.user_id
-            # return User.one(id=user_id)
+def load_current_user():
+    session_id = request.cookies.get('session_id')
+    if session_id is not None:
+        # 会话过期由 redis 的 TTL 负责，key 不存在时返回 None
+        user_id = session_user_id(session_id)
+        if user_id is not None:
             return cached_user_id2user(user_id)
 
 
+# csrf token 的有效期，单位秒
+csrf_token_ttl = 36000
+# 一次性 token 用过之后记在按小时分组的 set 中，set 在其中的 token 全部过期后自动删除
+csrf_used_key = 'csrf_used.{}'
+csrf_used_bucket = 3600
+
+
+def _csrf_signature(session_id, issued, nonce):
+    msg = '{}|{}|{}'.format(session_id, issued, nonce).encode('utf-8')
+    return hmac.new(current_app.secret_key.encode('utf-8'), msg, hashlib.sha256).hexdigest()[:32]
+
+
+def new_csrf_token():
+    """
+    生成绑定当前会话的 csrf token，格式是 签发时间.随机数.签名，签名是 secret_key 对会话 id、签发时间、随机数的 HMAC。
+    验证时只需要重新计算签名，不读写 redis。
+    """
+    session_id = request.cookies.get('session_id', '')
+    issued = int(time.time())
+    nonce = os.urandom(6).hex()
+    return '{}.{}.{}'.format(issued, nonce, _csrf_signature(session_id, issued, nonce))
+
+
+def valid_csrf_token(token):
+    """验证 token 是当前会话签发的并且没有过期，返回 (签发时间, 随机数)，无效时返回 None"""
+    try:
+        issued, nonce, signature = token.split('.')
+        issued = int(issued)
+    except (AttributeError, ValueError):
+        return None
+    if not 0 <= time.time() - issued <= csrf_token_ttl:
+        return None
+    session_id = request.cookies.get('session_id', '')
+    if not hmac.compare_digest(signature, _csrf_signature(session_id, issued, nonce)):
+        return None
+    return issued, nonce
+
+
+def use_csrf_token_once(issued, nonce):
+    """记录 token 已经用过，返回 False 表示之前已经用过"""
+    bucket = issued // csrf_used_bucket
+    key = csrf_used_key.format(bucket)
+    with user_identify_cache.pipeline() as pipe:
+        pipe.sadd(key, nonce)
+        pipe.expireat(key, (bucket + 1) * csrf_used_bucket + csrf_token_ttl)
+        added, _ = pipe.execute()
+    return added == 1
+
+
 def csrf_required(f):
+    """验证请求中的 csrf token，token 在有效期内可以重复使用"""
     @wraps(f)
     def wrapper(*args, **kwargs):
-        token = request.args['token']
-        key = 'csrf_token.{}'.format(token)
-        u = current_user()
-        if user_identify_cache.exists(key):
-            uid_from_redis = user_identify_cache.get(key)
-
-            if u.id == int(uid_from_redis):
-                user_identify_cache.delete(key)
-                return f(*args, **kwargs)
-        return abort(401)
+        if current_user() is None or valid_csrf_token(request.args.get('token')) is None:
+            return abort(401)
+        return f(*args, **kwargs)
 
     return wrapper
 
 
-def new_csrf_token():
-    u = current_user()
-    token = str(uuid.uuid4())
-    key = 'csrf_token.{}'.format(token)
-    if u is not None:
-        user_identify_cache.set(key, u.id)
-        user_identify_cache.expire(key, 36000)
-    return token
+def csrf_required_once(f):
+    """和 csrf_required 一样，但是 token 只能用一次，用在删除之类不能重放的操作上"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if current_user() is None:
+            return abort(401)
+        r = valid_csrf_token(request.args.get('token'))
+        if r is None or not use_csrf_token_once(*r):
+            return abort(401)
+        return f(*args, **kwargs)
+
+    return wrapper
 
 
 def login_required(func):
@@ -91,30 +156,62 @@ def at_names(content):
 
 
 def at_users(content):
-    users = []
-    for n in at_names(content):
-        i = User.one(username=n)
-        if i is not None:
-            users.append(i)
-    return users
+    """被 @ 的所有用户，用一条 IN 查询取出，同一个人 @ 多次只算一次"""
+    names = list(dict.fromkeys(at_names(content)))
+    if not names:
+        return []
+    return User.query.filter(User.username.in_(names)).all()
+
+
+def mentions_json(users):
+    """发表或修改时把被 @ 的用户存成 {用户名: user id}，渲染时不再查询"""
+    return json.dumps({u.username: u.id for u in users}, ensure_ascii=False)
+
+
+def send_infos(forms):
+    """
+    批量发送系统通知，forms 是 Info 字段(title, content, receiver_id)的字典列表。
+    所有通知一条 INSERT 写入，收件人的通知列表缓存和未读数在一个 pipeline 中更新。
+    """
+    if not forms:
+        return
+    Info.bulk_new(forms)
+    receivers = Counter(f['receiver_id'] for f in forms)
+    with data_cache.pipeline(transaction=False) as pipe:
+        for receiver_id, n in receivers.items():
+            key = 'user_id_{}.received_info'.format(receiver_id)
+            delete_cached_list(key, pipe)
+            incr_unread(receiver_id, 'info', n, pipe)
+        pipe.execute()
 
 
-def inform_at(topic, checked_content, caller):
+def at_info_forms(topic, called_users, caller):
     # topic:@ 发生的topic
-    # check_content:需要检查 @ 发生的文本
+    # called_users:正文或评论中被 @ 的用户，由 at_users 得到
     # caller:发送 @ 的用户
-
-    # 检查当前topic中的正文或评论中是否有用户使用@功能，有的话则发站内信提醒被@的用户。
-    called_users = at_users(checked_content)
-    with data_cache.pipeline(transaction=False) as pipe:
-        for called_user in called_users:
-            Info.send(title='{}@了你，快去看看吧。'.format(caller.username),
-                      content='用户{}@了你，点击{}/topic/{}查看。'
-                      .format(caller.username, web_domain_name, topic.id),
-                      receiver_id=called_user.id)
-            key = 'user_id_{}.received_info'.format(called_user.id)
-            pipe.delete(key)
-        pipe.execute()
+    # 返回提醒被@用户的系统通知，交给 send_infos 和其他通知一起发送
+    return [dict(title='{}@了你，快去看看吧。'.format(caller.username),
+                 content='用户{}@了你，点击{}/topic/{}查看。'
+                 .format(caller.username, web_domain_name, topic.id),
+                 receiver_id=called_user.id)
+            for called_user in called_users]
+
+
+def inform_at(topic, called_users, caller):
+    # 当前topic中的正文或评论中有用户使用@功能时，发站内信提醒被@的用户。
+    send_infos(at_info_forms(topic, called_users, caller))
+
+
+def topic_cells(topics):
+    """
+    为话题列表批量准备每一行要用的数据，返回 [(topic, 作者, 最后回复人), ...]，
+    没有回复的话题最后回复人为 None。
+    最后回复人和所有相关用户都是批量取出的，模板渲染时不再逐行查询。
+    """
+    topics = list(topics)
+    repliers = Topic.last_repliers(topics)
+    users = cached_user_ids2users([t.user_id for t in topics] + list(repliers.values()))
+    return [(t, users.get(t.user_id), users.get(repliers.get(t.id))) for t in topics]
 
 
 def topic_owner_required_post(func):
@@ -0,0 +1,69 @@
+import json
+import os
+
+from flask import request
+from markupsafe import Markup, escape
+
+# build_assets.py 生成的文件放在 static/build 下，文件名带内容的 hash，内容变了 url 就变，可以永久缓存
+static_dir = 'static'
+build_dir = os.path.join(static_dir, 'build')
+manifest_path = os.path.join(build_dir, 'manifest.json')
+build_url_prefix = '/static/build/'
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+# 合并成一个文件的 css，页面上每组只需要一个请求
+# build 目录和 css 目录同一层，合并后 css 中 ../img 这样的相对路径不变
+bundles = {
+    'site.css': ['css/bootstrap.min.css', 'css/style.css'],
+}
+
+_manifest = None
+
+
+def manifest():
+    """
+    {static 下的路径或 bundle 名字: build 后的路径}，每个进程第一次使用时读取，部署时 build 后需要重启。
+    没有执行 build(例如开发环境)时为空，页面使用原来的文件。
+    """
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(manifest_path, encoding='utf-8') as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+    return _manifest
+
+
+def asset_url(path):
+    """模板中使用，例如 {{ asset_url('css/errors.css') }}，返回带 hash 的 url"""
+    built = manifest().get(path)
+    if built is None:
+        return '/{}/{}'.format(static_dir, path)
+    return '/{}/{}'.format(static_dir, built)
+
+
+def stylesheet(name):
+    """
+    模板中使用，例如 {{ stylesheet('site.css') }}，返回 bundle 的 link 标签。
+    没有 build 时逐个引用 bundle 中的文件。
+    """
+    if name in manifest():
+        urls = [asset_url(name)]
+    else:
+        urls = [asset_url(p) for p in bundles[name]]
+    tags = ['<link rel="stylesheet" href="{}">'.format(escape(u)) for u in urls]
+    return Markup('\n    '.join(tags))
+
+
+def _after_request(response):
+    """没有 nginx 时 flask 直接提供 static 目录，同样给带 hash 的文件设置永久缓存"""
+    if request.path.startswith(build_url_prefix) and response.status_code == 200:
+        response.headers['Cache-Control'] = immutable_cache_control
+    return response
+
+
+def init_assets(app):
+    app.template_global()(asset_url)
+    app.template_global()(stylesheet)
+    app.after_request(_after_request)
@@ -0,0 +1,168 @@
+import hashlib
+import io
+import json
+import os
+from functools import lru_cache
+
+from models.user import User
+from routes.myredis import user_identify_cache, model_changed
+from utils import write_file_atomic
+
+# 请求中用到的头像配置和函数。生成缩略图、gc 等只在 avatar_queue.py 的 worker 中执行，
+# PIL 只在检查上传的图片时才导入，web worker 启动时不加载
+
+# 上传限制：文件大小、图片像素数和允许的格式，超过限制的请求中直接拒绝，不进入队列
+avatar_max_bytes = 5 * 1024 * 1024
+avatar_max_pixels = 4096 * 4096
+avatar_formats = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+# 每个头像生成的正方形缩略图边长，按页面上显示尺寸的两倍生成，高分屏也清晰
+# profile 是个人主页和设置页的大图，list 是话题列表和用户卡片，small 是最后回复人的小头像
+avatar_sizes = dict(
+    profile=256,
+    list=96,
+    small=48,
+)
+
+# 处理后的头像按原图内容的 sha1 命名：images/avatars/{前两位}/{sha1}.webp 是 profile 尺寸，
+# 其他尺寸是 {sha1}-{边长}.webp。文件名由内容决定、写入后不再修改，nginx 可以设置永久缓存，
+# 相同的图片只保存一份
+avatar_dir = os.path.join('images', 'avatars')
+avatar_url_prefix = '/images/avatars/'
+# 等待处理的原图，不在 images 下，nginx 不会对外提供
+avatar_incoming_dir = os.path.join('uploads', 'avatars')
+# 旧版本保存的头像，原图直接放在 images 下
+legacy_avatar_prefix = '/images/avatar_uid='
+
+# 待处理的头像，请求中 LPUSH，worker BRPOPLPUSH 到 processing 中处理，处理完后从 processing 删除
+avatar_queue_key = 'avatar_queue'
+avatar_processing_key = 'avatar_queue.processing'
+# 每个用户上传头像的序号，每次上传加一。队列中的任务带着上传时的序号，
+# 处理时序号已经不是最新的说明用户之后又换了头像，这个任务直接跳过，不会把新头像改回旧的
+avatar_seq_key = 'user_id_{}.avatar_seq'
+avatar_seq_ttl = 7 * 86400
+
+
+@lru_cache(maxsize=1)
+def avatar_output():
+    """返回 (缩略图的格式, 扩展名)，Pillow 编译时带了 WebP 支持就输出 WebP，否则输出 JPEG"""
+    from PIL import features
+    if features.check('webp'):
+        return 'WEBP', '.webp'
+    return 'JPEG', '.jpg'
+
+
+def avatar(image, size='list'):
+    """
+    模板过滤器，返回头像指定尺寸的 url，例如 {{ user.image | avatar('small') }}。
+    默认头像和旧版本上传的头像只有一个文件，原样返回。
+    """
+    if not image.startswith(avatar_url_prefix) or size == 'profile':
+        return image
+    base, ext = os.path.splitext(image)
+    return '{}-{}{}'.format(base, avatar_sizes[size], ext)
+
+
+def avatar_paths(digest):
+    """返回 {尺寸: 文件路径}"""
+    _, ext = avatar_output()
+    d = os.path.join(avatar_dir, digest[:2])
+    paths = {}
+    for name, px in avatar_sizes.items():
+        if name == 'profile':
+            paths[name] = os.path.join(d, digest + ext)
+        else:
+            paths[name] = os.path.join(d, '{}-{}{}'.format(digest, px, ext))
+    return paths
+
+
+def avatar_url(digest):
+    _, ext = avatar_output()
+    return '{}{}/{}{}'.format(avatar_url_prefix, digest[:2], digest, ext)
+
+
+def check_upload(data):
+    """
+    只读取图片头部检查格式和尺寸，不解码像素，请求中调用。
+    超过限制或者不是图片时抛出 ValueError，错误信息可以直接展示给用户。
+    """
+    from PIL import Image
+    if len(data) > avatar_max_bytes:
+        raise ValueError('头像文件不能超过 {}MB'.format(avatar_max_bytes // 1024 // 1024))
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Exception:
+        raise ValueError('无法识别的图片文件')
+    if img.format not in avatar_formats:
+        raise ValueError('头像只支持 JPEG、PNG、GIF 和 WebP 格式')
+    w, h = img.size
+    if w * h > avatar_max_pixels:
+        raise ValueError('图片尺寸过大')
+
+
+def submit_avatar(user_id, data):
+    """
+    请求中调用，data 是已经通过 check_upload 检查的原图。
+    同样的图片已经处理过时直接设置，返回 True；否则保存原图放进队列，由 worker 处理后设置，返回 False。
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    key = avatar_seq_key.format(user_id)
+    with user_identify_cache.pipeline() as pipe:
+        pipe.incr(key)
+        pipe.expire(key, avatar_seq_ttl)
+        seq, _ = pipe.execute()
+
+    # 更新文件的修改时间，gc 在宽限期内不会删除它们，touch 失败说明文件不完整，重新生成
+    if touch_files(avatar_paths(digest).values()):
+        set_user_avatar(user_id, digest)
+        return True
+
+    os.makedirs(avatar_incoming_dir, exist_ok=True)
+    path = os.path.join(avatar_incoming_dir, digest)
+    write_file_atomic(path, data)
+    job = dict(
+        user_id=user_id,
+        digest=digest,
+        seq=seq,
+    )
+    user_identify_cache.lpush(avatar_queue_key, json.dumps(job))
+    return False
+
+
+def is_avatar_file(image):
+    """image 是否是上传的头像，默认头像等其他图片不会被删除"""
+    return image.startswith(avatar_url_prefix) or image.startswith(legacy_avatar_prefix)
+
+
+def image_files(image):
+    """头像 url 对应的所有文件路径"""
+    if image.startswith(avatar_url_prefix):
+        digest = os.path.splitext(os.path.basename(image))[0]
+        return list(avatar_paths(digest).values())
+    else:
+        return [os.path.join('images', image[len('/images/'):])]
+
+
+def touch_files(paths):
+    """把文件的修改时间改成现在，gc 的宽限期从现在开始算。有文件不存在时返回 False"""
+    try:
+        for p in paths:
+            os.utime(p)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def set_user_avatar(user_id, digest):
+    u = User.one(id=user_id)
+    if u is None:
+        return
+    old = u.image
+    new = avatar_url(digest)
+    if old == new:
+        return
+    new_u = User.update(user_id, image=new)
+    model_changed(new_u)
+    # 旧头像由 gc 在宽限期过后删除，其他用户可能正在使用同一张图片，缓存中的旧数据也还在引用它
+    if is_avatar_file(old):
+        touch_files(image_files(old))
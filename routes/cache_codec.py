@@ -0,0 +1,110 @@
+import hashlib
+import json
+import types
+
+import msgpack
+
+# 缓存中的对象按列的顺序编码成数组，不保存字段名。可选 'msgpack' 或 'json'
+cache_codec = 'msgpack'
+
+codecs = dict(
+    msgpack=(
+        lambda values: msgpack.packb(values, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    ),
+    json=(
+        lambda values: json.dumps(values, ensure_ascii=False).encode('utf-8'),
+        lambda data: json.loads(data),
+    ),
+)
+
+_views = {}
+_schema_versions = {}
+
+
+class ModelView(object):
+    """
+    缓存中读出的只读对象，用来渲染页面，代替 get_model 生成的 SQLAlchemy 对象。
+    字段存在 __slots__ 中，model 的方法(例如 Reply.user)在访问时绑定到视图上调用。
+    要修改数据请从数据库查出 model 对象。
+    """
+    __slots__ = ()
+    model = None
+    fields = ()
+
+    def __init__(self, values):
+        for name, v in zip(self.fields, values):
+            object.__setattr__(self, name, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} 是缓存中的只读对象'.format(self.__class__.__name__))
+
+    def __getattr__(self, name):
+        v = getattr(self.model, name)
+        if isinstance(v, types.FunctionType):
+            return types.MethodType(v, self)
+        return v
+
+    def json(self):
+        return dict(zip(self.fields, (getattr(self, f) for f in self.fields)))
+
+    def __repr__(self):
+        s = ''.join('{}: ({})\n'.format(f, getattr(self, f)) for f in self.fields)
+        return '< {}\n{} >\n'.format(self.__class__.__name__, s)
+
+
+def view_class(model):
+    """每个 model 对应一个 ModelView 的子类，__slots__ 是 model 的所有列"""
+    cls = _views.get(model)
+    if cls is None:
+        fields = tuple(attr for attr, column in model.columns())
+        cls = type(model.__name__ + 'View', (ModelView,), dict(
+            __slots__=fields,
+            model=model,
+            fields=fields,
+        ))
+        _views[model] = cls
+    return cls
+
+
+def schema_version(model):
+    """
+    编码方式和 model 的列名、列类型算出的版本号。
+    model 增删改列或者更换编码方式后版本号变化，缓存 key 随之变化，不会读到旧的格式。
+    """
+    columns = ','.join('{}:{}'.format(attr, column.type) for attr, column in model.columns())
+    h = hashlib.sha1('{}|{}'.format(cache_codec, columns).encode('utf-8')).hexdigest()
+    return h[:8]
+
+
+def model_version(model):
+    version = _schema_versions.get(model)
+    if version is None:
+        version = _schema_versions[model] = schema_version(model)
+    return version
+
+
+def cache_key(model, id):
+    """单个对象的缓存 key，例如 'user.3f2a9c1e.12'"""
+    return '{}.{}.{}'.format(model.__name__.lower(), model_version(model), id)
+
+
+def encode(m):
+    """model 对象或 ModelView 编码成 bytes"""
+    model = m.model if isinstance(m, ModelView) else type(m)
+    dumps, loads = codecs[cache_codec]
+    return dumps([getattr(m, f) for f in view_class(model).fields])
+
+
+def as_view(m):
+    """数据库中查出的 model 对象转成 ModelView，可以在多个请求之间共享"""
+    if isinstance(m, ModelView):
+        return m
+    cls = view_class(type(m))
+    return cls([getattr(m, f) for f in cls.fields])
+
+
+def decode(model, data):
+    """bytes 解码成 model 对应的 ModelView"""
+    dumps, loads = codecs[cache_codec]
+    return view_class(model)(loads(data))
@@ -8,9 +8,11 @@ from flask import (render_template,
                    )
 
 from config import admin_mail
-from models.message import send_mail
+from mail_queue import enqueue_mail
 from models.user import User
-from routes.myredis import user_identify_cache
+from routes.myredis import user_identify_cache, model_changed
+from routes.session_store import revoke_user_sessions
+from utils import log
 
 main = Blueprint('forget', __name__)
 
@@ -26,14 +28,14 @@ def forget():
 def forget_post():
     reset_token = str(uuid.uuid4())
     mail_addr = request.form.get('mail_address').strip()
-    print('发送的邮件地址:', mail_addr)
+    log('发送的邮件地址:', mail_addr)
     user = User.one(email=mail_addr)
     if user is not None:
         v = user.id
         key = 'reset_token.{}'.format(reset_token)
         user_identify_cache.set(key, v)
         try:
-            send_mail(
+            enqueue_mail(
                 subject='Swordman BBS - 重置密码',
                 author=admin_mail,
                 to=mail_addr,
@@ -76,7 +78,10 @@ def forget_reset_post():
             user_id = int(user_identify_cache.get(k))
             new_pass = request.form.get('new_pass')
             if len(new_pass) > 2:
-                User.update(user_id, password=User.salted_password(new_pass))
+                u = User.update(user_id, password=User.salted_password(new_pass))
+                model_changed(u)
+                # 重置密码后所有设备都需要重新登录
+                revoke_user_sessions(user_id)
                 flash('密码重置成功，请重新登陆')
                 return redirect('/')
             else:
@@ -1,4 +1,3 @@
-import json
 from random import randint
 
 from flask import (
@@ -11,11 +10,19 @@ from flask import (
 )
 
 from config import admin_mail
-from models.message import send_mail
-from models.session import ServerSession
+from mail_queue import enqueue_mail
 from models.user import User
-from routes import current_user
+from routes import (current_user,
+                    forget_current_user,
+                    login_required,
+                    csrf_required,
+                    )
 from routes.myredis import user_identify_cache
+from routes.session_store import (new_session,
+                                  revoke_session,
+                                  revoke_user_sessions,
+                                  session_max_age,
+                                  )
 
 main = Blueprint('index', __name__)
 
@@ -52,7 +59,7 @@ def register_check_mail():
         content = '欢迎注册Swordman BBS。您的验证码为{}，' \
                   '如果不是您本人的操作，请无视本邮件。'.format(verify_code)
         try:
-            send_mail(
+            enqueue_mail(
                 subject=title,
                 author=admin_mail,
                 to=email,
@@ -103,10 +110,8 @@ def login_post():
 
         # 使用redis实现服务端session:
         response = make_response(redirect(url_for('my_topic.index')))
-        user_session = ServerSession.new(u.id)
-        response.headers['Set-Cookie'] = 'session_id=' + user_session.session_id
-        key = 'session_id.{}'.format(user_session.session_id)
-        user_identify_cache.set(key, json.dumps(user_session.todict()))
+        session_id = new_session(u.id)
+        response.set_cookie('session_id', session_id, max_age=session_max_age, httponly=True)
 
         return response
 
@@ -118,7 +123,21 @@ def not_found(e):
 @main.route('/logout')
 def logout():
     session_id = request.cookies.get('session_id')
-    key = 'session_id.{}'.format(session_id)
-    if session_id is not None and user_identify_cache.exists(key):
-        user_identify_cache.delete(key)
-    return redirect('/')
\ No newline at end of file
+    if session_id is not None:
+        revoke_session(session_id)
+    forget_current_user()
+    response = make_response(redirect('/'))
+    response.delete_cookie('session_id')
+    return response
+
+
+@main.route('/logout/all', methods=['POST'])
+@login_required
+@csrf_required
+def logout_all():
+    """注销该用户在所有设备上的登录"""
+    revoke_user_sessions(current_user().id)
+    forget_current_user()
+    response = make_response(redirect('/'))
+    response.delete_cookie('session_id')
+    return response
\ No newline at end of file
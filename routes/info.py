@@ -9,6 +9,7 @@ from flask import (render_template,
 from models.info import Info
 from routes import (login_required,
                     csrf_required,
+                    csrf_required_once,
                     current_user,
                     new_csrf_token,
                     )
@@ -16,6 +17,12 @@ from routes import (login_required,
 from routes.myredis import (cached_received_info,
                             cached_user_id2user,
                             data_cache,
+                            unread_count,
+                            incr_unread,
+                            clear_unread,
+                            set_cached_model,
+                            delete_cached_models,
+                            delete_cached_list,
                             )
 
 main = Blueprint('info', __name__)
@@ -25,10 +32,7 @@ main = Blueprint('info', __name__)
 def unread_info_num_of_user(u):
     """用于显示未读信息数"""
     if u is not None:
-        uid = u.id
-        all_info = cached_received_info(uid)
-        unread_info = [i for i in all_info if not i.been_read]
-        n = len(unread_info)
+        n = unread_count(u.id, 'info')
         if n > 0:
             return '[%d]' % n
     return ''
@@ -54,7 +58,7 @@ def info():
 
 @main.route('/deletion', methods=['POST'])
 @login_required
-@csrf_required
+@csrf_required_once
 def delete():
     """执行系统通知的删除操作"""
     u = current_user()
@@ -65,7 +69,9 @@ def delete():
         if i.receiver_id == u.id:
             Info.delete(i)
             key = 'user_id_{}.received_info'.format(u.id)
-            data_cache.delete(key)
+            delete_cached_list(key)
+            if not i.been_read:
+                incr_unread(u.id, 'info', -1)
             return redirect(url_for('.info'))
 
     return abort(404)
@@ -83,8 +89,8 @@ def detail(info_id):
     if not i.been_read:
         i.been_read = True
         i.save()
-        key = 'info_id_{}.info'.format(i.id)
-        data_cache.delete(key)
+        set_cached_model(i)
+        incr_unread(u.id, 'info', -1)
 
     token = new_csrf_token()
     return render_template("info/info_detail.html", user=u, info=i, token=token)
@@ -92,7 +98,7 @@ def detail(info_id):
 
 @main.route('/sweeper', methods=['POST'])
 @login_required
-@csrf_required
+@csrf_required_once
 def sweep():
     """清理所有已读信息"""
     u = current_user()
@@ -100,13 +106,12 @@ def sweep():
     owner = cached_user_id2user(owner_id)
     if owner is not None:
         if owner_id == u.id:
-            read_infos = Info.all(receiver_id=owner_id, been_read=True)
-            with data_cache.pipeline(transaction=False) as pipe:
-                for i in read_infos:
-                    Info.delete(i)
-                    key = 'user_id_{}.received_info'.format(u.id)
-                    pipe.delete(key)
-                pipe.execute()
+            deleted_ids = Info.bulk_delete(receiver_id=owner_id, been_read=True)
+            if deleted_ids:
+                with data_cache.pipeline(transaction=False) as pipe:
+                    delete_cached_models(Info, deleted_ids, pipe)
+                    delete_cached_list('user_id_{}.received_info'.format(u.id), pipe)
+                    pipe.execute()
 
     return redirect(url_for('.info'))
 
@@ -120,14 +125,11 @@ def set_read():
     owner = cached_user_id2user(owner_id)
     if owner is not None:
         if owner_id == u.id:
-            unread_info = Info.all(receiver_id=owner_id, been_read=False)
+            read_ids = Info.bulk_update(dict(been_read=True), receiver_id=owner_id, been_read=False)
 
             with data_cache.pipeline(transaction=False) as pipe:
-                for i in unread_info:
-                    i.been_read = True
-                    i.save()
-                    key = 'info_id_{}.info'.format(i.id)
-                    pipe.delete(key)
+                delete_cached_models(Info, read_ids, pipe)
+                clear_unread(u.id, 'info', pipe)
                 pipe.execute()
 
     return redirect(url_for('.info'))
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utils import log
+
+# 各 worker 通过这个频道通知其他 worker 丢掉进程内缓存
+invalidate_channel = 'local_cache.invalidate'
+# 订阅断开后隔多久重连，单位秒
+resubscribe_delay = 1
+# 每次等待通知的最长时间，单位秒
+listen_timeout = 30
+
+_caches = {}
+_client = None
+_listener_pid = None
+
+
+class LocalCache(object):
+    """
+    每个 worker 进程内的 LRU 缓存，放在 redis 的 data_cache 前面，用来缓存很少变化但是经常读取的对象。
+    超过 maxsize 时淘汰最久没有用到的，超过 ttl 秒的数据当作不存在。
+    存进来的对象会被多个请求共享，只放只读的 ModelView，不要放 SQLAlchemy 对象。
+    """
+
+    def __init__(self, name, maxsize, ttl, client):
+        global _client
+        _client = client
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        _caches[name] = self
+
+    def get(self, key):
+        """返回缓存的值，不存在或者过期时返回 None"""
+        ensure_listener()
+        item = self._data.get(key)
+        if item is None or item[0] < time.time():
+            self.misses += 1
+            return None
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            # 刚好被其他 greenlet 删除
+            pass
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.time() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key=None):
+        """只清理本进程的缓存，key 为 None 时全部清理"""
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def invalidate(self, key=None, pipe=None):
+        """数据修改后调用，清理本进程的缓存，并通知所有 worker 清理"""
+        self.discard(key)
+        message = json.dumps(dict(cache=self.name, key=key))
+        (pipe or _client).publish(invalidate_channel, message)
+
+    def stats(self):
+        return dict(
+            name=self.name,
+            size=len(self._data),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
+
+
+def local_cache_stats():
+    return [c.stats() for c in _caches.values()]
+
+
+def _on_message(message):
+    d = json.loads(message['data'])
+    c = _caches.get(d['cache'])
+    if c is not None:
+        c.discard(d['key'])
+
+
+def _listen():
+    """
+    订阅失效通知。断线期间可能错过通知，所以每次(重新)订阅成功后清空所有进程内缓存。
+    任何异常都不能让线程退出，否则这个 worker 的进程内缓存再也收不到失效通知。
+    """
+    while True:
+        pubsub = None
+        try:
+            pubsub = _client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(invalidate_channel)
+            for c in _caches.values():
+                c.discard()
+            while True:
+                # 不用 listen()，连接设置了 socket_timeout，空闲时阻塞读取会超时断开
+                message = pubsub.get_message(timeout=listen_timeout)
+                if message is None:
+                    continue
+                try:
+                    _on_message(message)
+                except Exception as e:
+                    # 无法解析的通知不知道该清理哪个 key，全部清空
+                    log('进程内缓存失效通知无法处理', message, e, level=logging.WARNING)
+                    for c in _caches.values():
+                        c.discard()
+        except Exception as e:
+            log('进程内缓存失效通知订阅断开', e, level=logging.WARNING)
+            time.sleep(resubscribe_delay)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+def ensure_listener():
+    """
+    每个 worker 进程第一次使用进程内缓存时启动订阅线程。
+    gunicorn 的 gevent worker 中 threading 已经被替换成 greenlet。
+    按进程号判断，fork 出来的子进程会重新启动。
+    """
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid != pid:
+        _listener_pid = pid
+        t = threading.Thread(target=_listen, daemon=True)
+        t.start()
@@ -16,7 +16,14 @@ from routes import (login_required,
                     )
 from routes.myredis import (cached_sent_message,
                             data_cache,
-                            cached_received_message,)
+                            cached_received_message,
+                            unread_count,
+                            incr_unread,
+                            clear_unread,
+                            push_cached_list,
+                            set_cached_model,
+                            delete_cached_models,
+                            )
 
 main = Blueprint('mail', __name__)
 
@@ -39,10 +46,7 @@ def get_receiver(k):
 def unread_message_num_of_user(u):
     """获取未读私信条数"""
     if u is not None:
-        uid = u.id
-        all_messages = cached_received_message(uid)
-        unread_messages = [m for m in all_messages if not m.been_read]
-        n = len(unread_messages)
+        n = unread_count(u.id, 'message')
         if n > 0:
             return '[%d]' % n
     return ''
@@ -57,14 +61,11 @@ def set_read():
     receiver = cached_user_id2user(receiver_id)
     if receiver is not None:
         if receiver_id == u.id:
-            unread_messages = Messages.all(receiver_id=receiver_id, been_read=False)
+            read_ids = Messages.bulk_update(dict(been_read=True), receiver_id=receiver_id, been_read=False)
 
             with data_cache.pipeline(transaction=False) as pipe:
-                for message in unread_messages:
-                    key = 'message_id_{}.message'.format(message.id)
-                    message.been_read = True
-                    message.save()
-                    pipe.delete(key)
+                delete_cached_models(Messages, read_ids, pipe)
+                clear_unread(u.id, 'message', pipe)
                 pipe.execute()
 
     return redirect(url_for('.inbox'))
@@ -90,18 +91,20 @@ def add():
     elif receiver.id == u.id or receiver.username == u.username:
         flash('私信是发给其他人的哦，请重新输入收件人')
     else:
-        Messages.send(
+        m = Messages.send(
             title=form['title'],
             content=form['content'],
             sender_id=u.id,
             receiver_id=receiver.id,
         )
         flash('发送成功')
+        # 新私信的 id 直接加到双方私信列表缓存的开头
         with data_cache.pipeline(transaction=False) as pipe:
             key = 'user_id_{}.sent_message'.format(u.id)
-            key2 = 'user_id_{}.received_message'.format(receiver_id)
-            pipe.delete(key)
-            pipe.delete(key2)
+            key2 = 'user_id_{}.received_message'.format(receiver.id)
+            push_cached_list(key, m.id, left=True, pipe=pipe)
+            push_cached_list(key2, m.id, left=True, pipe=pipe)
+            incr_unread(receiver.id, 'message', 1, pipe)
             pipe.execute()
     return redirect(url_for('.index'))
 
@@ -167,8 +170,8 @@ def view(id):
         if is_receiver and not message.been_read:
             message.been_read = True
             message.save()
-            key = 'message_id_{}.message'.format(message.id)
-            data_cache.delete(key)
+            set_cached_model(message)
+            incr_unread(u.id, 'message', -1)
 
         return render_template('mail/detail.html', message=message, user=u)
     else:
@@ -1,150 +1,556 @@
+import hashlib
 import json
+import logging
+import os
+import time
 
 import redis
 
+from models.board import Board
 from models.info import Info
 from models.message import Messages
 from models.reply import Reply
+from models.search import SearchDoc
 from models.topic import Topic
 from models.user import User
-from utils import log
+from routes.cache_codec import cache_key, model_version, encode, decode, as_view
+from routes.local_cache import LocalCache
+from utils import cache_stat, log
 
-user_identify_cache = redis.StrictRedis(db=0)
-data_cache = redis.StrictRedis(db=1)
+# redis 的连接配置
+redis_host = 'localhost'
+redis_port = 6379
+# 设置后通过 unix socket 连接，忽略 host 和 port，例如 '/var/run/redis/redis-server.sock'
+redis_unix_socket_path = None
+redis_password = None
+# 每个 worker 进程每个 db 一个连接池，gevent 下所有 greenlet 共用。
+# 连接用完时最多等待 redis_pool_timeout 秒，而不是无限制地新建连接
+redis_max_connections = 50
+redis_pool_timeout = 1
+# 单位秒，redis 卡住时请求最多等待这么久，超时会重试一次
+redis_socket_timeout = 0.5
+redis_connect_timeout = 0.5
+# 连接空闲超过这么多秒，下次使用前先 PING 检查一下
+redis_health_check_interval = 30
+# data_cache 出错后多少秒内不再访问 redis：读缓存全部当作未命中，直接查数据库；写缓存直接跳过。
+# 只有清理缓存的命令照常发送，数据库修改后的失效通知不能因为之前的一次超时被跳过
+redis_down_seconds = 5
 
+# 只读的命令，redis 不可用期间直接返回未命中的结果
+_read_commands = {
+    'GET', 'MGET', 'LRANGE', 'LLEN', 'HGET', 'HMGET', 'HGETALL',
+    'ZRANGEBYSCORE', 'SCAN', 'EXISTS', 'TTL', 'PTTL', 'SMEMBERS', 'SCARD',
+}
 
-def cached_user_id2user(user_id):
+# 清理缓存的命令，redis 不可用期间也要发送：删除 key、通知其他 worker、
+# 增加列表的版本号，以及写缓存用的脚本(脚本中会检查版本号或者增加版本号)
+_invalidate_commands = {'DEL', 'UNLINK', 'PUBLISH', 'INCR', 'EVALSHA', 'EVAL', 'SCRIPT'}
+
+# data_cache 出错时各个命令返回的结果，和缓存不存在时的结果一致，没有列出的命令返回 None
+_empty_results = dict(
+    MGET=lambda args: [None] * (len(args) - 1),
+    LRANGE=lambda args: [],
+    ZRANGEBYSCORE=lambda args: [],
+    HGETALL=lambda args: {},
+    SCAN=lambda args: (0, []),
+    EXISTS=lambda args: 0,
+    DEL=lambda args: 0,
+    HINCRBY=lambda args: 0,
+    PUBLISH=lambda args: 0,
+    SMEMBERS=lambda args: set(),
+)
+
+
+def _empty_result(args):
+    f = _empty_results.get(args[0].upper())
+    return None if f is None else f(args)
+
+
+def _is_read(args):
+    return args[0].upper() in _read_commands
+
+
+def _must_send(stack):
+    """redis 不可用期间，包含清理缓存命令的调用(或者 pipeline)照常发送，其他的跳过"""
+    return any(args[0].upper() in _invalidate_commands for args in stack)
+
+
+class _Breaker(object):
+    """记录 redis 是否可用，出错后 redis_down_seconds 秒内只发送清理缓存的命令"""
+
+    def __init__(self):
+        self.down_until = 0
+
+    def is_down(self):
+        return time.time() < self.down_until
+
+    def trip(self, e):
+        if not self.is_down():
+            log('redis 不可用，{}秒内缓存直接查数据库'.format(redis_down_seconds), e, level=logging.WARNING)
+        self.down_until = time.time() + redis_down_seconds
+
+    def recover(self):
+        """写命令成功说明 redis 已经恢复，读命令不用等到 down_until"""
+        self.down_until = 0
+
+
+class FallbackPipeline(redis.client.Pipeline):
+    breaker = None
+
+    def execute(self, raise_on_error=True):
+        stack = [args for args, options in self.command_stack]
+        reads_only = all(_is_read(args) for args in stack)
+        if self.breaker.is_down() and not _must_send(stack):
+            self.reset()
+            return [_empty_result(args) for args in stack]
+        try:
+            result = super().execute(raise_on_error)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.trip(e)
+            return [_empty_result(args) for args in stack]
+        if not reads_only:
+            self.breaker.recover()
+        return result
+
+
+class FallbackRedis(redis.StrictRedis):
     """
-    根据user id 返回 User 对象。
-    如果缓存命中，则从缓存中拉取包含topic信息的字典，使用get_model得到topic对象。
-    如果缓存穿透，则从数据库查询，拿到数据后将数据序列化后存储到redis。
+    缓存用的 redis 客户端。redis 连接失败或超时时不抛出异常，
+    读命令返回和缓存不存在时一样的结果，由调用方查数据库，避免 redis 故障时整站 500。
+    出错后一段时间内读命令和写缓存的命令不再访问 redis，请求不会每次都等待超时；
+    清理缓存的命令每次都会尝试，失败时只记日志，漏掉的更新靠缓存的过期时间修复，
+    所以 data_cache 中的 key 都要有过期时间。
+    只能用在 data_cache 这种丢了也能从数据库重建的数据上。
     """
-    key = 'user_id_{}.user_info'.format(user_id)
-    try:
-        # 拿到json 格式的数据
-        v = data_cache[key]
-    except KeyError:
-        # 如果没有缓存
-        user = User.one(id=user_id)
-        v = json.dumps(user.json())
-        data_cache.set(key, v)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
-        return user
-    else:
-        # json序列化为dict，dict生成User对象
-        d = json.loads(v)
-        user = User.get_model(d)
-        log('缓存命中，直接使用')
 
-        return user
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = _Breaker()
 
+    def execute_command(self, *args, **options):
+        read = _is_read(args)
+        if self.breaker.is_down() and not _must_send([args]):
+            return _empty_result(args)
+        try:
+            result = super().execute_command(*args, **options)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.trip(e)
+            return _empty_result(args)
+        if not read:
+            self.breaker.recover()
+        return result
 
-def cached_topic_id2topic(topic_id):
+    def pipeline(self, transaction=True, shard_hint=None):
+        p = FallbackPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        p.breaker = self.breaker
+        return p
+
+
+def redis_client(db, client_class=redis.StrictRedis, **kwargs):
     """
-    根据topic_id 返回对应的Topic 对象。
-    如果缓存命中，则从缓存中拉取包含Topic信息的字典，使用get_model得到Topic对象。
-    如果缓存穿透，则从数据库查询，拿到数据后将数据序列化后存储到redis。
+    按上面的配置创建 redis 客户端，kwargs 覆盖默认的连接参数，
+    例如 mail_queue 的 worker 使用阻塞命令，需要更长的 socket_timeout。
     """
-    key = 'topic_id_{}.topic_info'.format(topic_id)
-    try:
-        # 缓存命中
-        v = data_cache[key]
-    except KeyError:
-        # 缓存未命中，数据库中拉取数据
-        topic = Topic.one(id=topic_id)
-        v = json.dumps(topic.json())
-        # 加到redis缓存中的是topic id
-        data_cache.set(key, v, 300)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
-        return topic
+    options = dict(
+        db=db,
+        password=redis_password,
+        socket_timeout=redis_socket_timeout,
+        socket_connect_timeout=redis_connect_timeout,
+        retry_on_timeout=True,
+        health_check_interval=redis_health_check_interval,
+    )
+    if redis_unix_socket_path is None:
+        options.update(host=redis_host, port=redis_port, socket_keepalive=True)
     else:
-        # json序列化为dict，dict生成Topic对象
-        d = json.loads(v)
-        topic = Topic.get_model(d)
-        log('缓存命中，直接使用')
-        return topic
+        options.update(path=redis_unix_socket_path, connection_class=redis.UnixDomainSocketConnection)
+    options.update(kwargs)
+    pool = redis.BlockingConnectionPool(
+        max_connections=redis_max_connections,
+        timeout=redis_pool_timeout,
+        **options
+    )
+    return client_class(connection_pool=pool)
 
 
-def cached_reply_id2reply(reply_id):
+# 登录状态、验证码、邮件队列，只存在 redis 中，出错时照常抛出异常
+user_identify_cache = redis_client(0)
+# 缓存，redis 出错时当作缓存未命中
+data_cache = redis_client(1, FallbackRedis)
+# 同一个 db 中不能从数据库重建的数据(还没写回数据库的浏览数)，出错时照常抛出异常，不能当作不存在
+views_cache = redis_client(1)
+
+# 每个 worker 进程内的缓存，放在 data_cache 前面。修改后通过 redis 的 pub/sub 通知所有 worker
+local_users = LocalCache('user', maxsize=10000, ttl=60, client=data_cache)
+local_boards = LocalCache('board', maxsize=1, ttl=300, client=data_cache)
+
+# 缓存未命中时只让一个请求查数据库重建缓存，其他请求等待，锁的过期时间防止持有锁的请求异常退出后死锁
+rebuild_lock_ms = 3000
+# 等待别的请求重建缓存时的轮询间隔和次数，超时后自己查数据库
+rebuild_wait = 0.02
+rebuild_wait_times = 50
+
+# 只删除自己加的锁，锁过期后被别的请求拿到时不能误删
+_release_lock = data_cache.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# 列表缓存(json 数组和回复 list)的版本号 '{key}.version'，每次追加或删除列表时加一。
+# 重建列表的请求在查数据库之前读取版本号，写缓存时版本号变了说明期间有写操作，
+# 查到的数据可能缺少新加的元素，放弃写缓存，下一个读者再重建
+list_version_ttl = 86400
+
+# 在缓存的 json 数组的开头(ARGV[2] 为 'left')或结尾加一个元素，保留原来的过期时间。
+# 缓存不存在时只增加版本号，等下次读取时从数据库重建。
+_push_json_item = data_cache.register_script("""
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+local v = redis.call('GET', KEYS[1])
+if not v then
+    return 0
+end
+local s
+if v == '[]' then
+    s = '[' .. ARGV[1] .. ']'
+elseif ARGV[2] == 'left' then
+    s = '[' .. ARGV[1] .. ', ' .. string.sub(v, 2)
+else
+    s = string.sub(v, 1, -2) .. ', ' .. ARGV[1] .. ']'
+end
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], s, 'PX', ttl)
+else
+    redis.call('SET', KEYS[1], s)
+end
+return 1
+""")
+
+# 版本号(不存在时为空字符串)和 ARGV[1] 一致时才写入缓存，ARGV[2] 是值，ARGV[3] 是过期时间
+_set_if_version = data_cache.register_script("""
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+""")
+
+# 和 _set_if_version 一样，写入的是 list，ARGV[3] 之后是 list 的元素
+_rebuild_list_if_version = data_cache.register_script("""
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 1000 do
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+def single_flight(key, load, read):
     """
-    根据reply id 返回 Reply 对象。
-    如果缓存命中，则从缓存中拉取包含Reply 信息的字典，使用get_model得到Reply 对象。
-    如果缓存穿透，则从数据库查询，拿到数据后将数据序列化后存储到redis。
+    缓存 key 未命中时调用，避免热门话题的缓存过期后一批请求同时查数据库。
+    拿到锁的请求调用 load() 查数据库并写缓存，返回 load() 的结果；
+    其他请求轮询 read() 等待缓存建好，read() 在缓存不存在时返回 None，
+    等待超时或锁释放后仍没有缓存则自己调用 load()。
     """
-    key = 'reply_id_{}.reply_info'.format(reply_id)
-    try:
-        # 拿到json 格式的数据
-        v = data_cache[key]
-    except KeyError:
-        # 如果没有缓存
-        reply = Reply.one(id=reply_id)
-        v = json.dumps(reply.json())
-        data_cache.set(key, v, 3600)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
-        return reply
-    else:
-        # json序列化为dict，dict生成Reply对象
-        d = json.loads(v)
-        reply = Reply.get_model(d)
-        log('缓存命中，直接使用')
-        return reply
+    if data_cache.breaker.is_down():
+        return load()
+    lock_key = 'lock.{}'.format(key)
+    token = os.urandom(8).hex()
+    if data_cache.set(lock_key, token, px=rebuild_lock_ms, nx=True):
+        try:
+            return load()
+        finally:
+            _release_lock(keys=[lock_key], args=[token])
 
+    for _ in range(rebuild_wait_times):
+        # gunicorn 使用 gevent worker，sleep 时会切换到其他请求
+        time.sleep(rebuild_wait)
+        v = read()
+        if v is not None:
+            return v
+        if not data_cache.exists(lock_key):
+            # 锁已经释放但没有写缓存，例如数据不存在
+            break
+    return load()
 
-def cached_info_id2info(info_id):
+
+# 单个对象缓存的过期时间。修改后会直接覆盖缓存，但 redis 故障时覆盖可能失败，
+# 所以都设置过期时间，漏掉的更新最多持续这么久
+cache_ttl = {
+    User: 86400,
+    Topic: 300,
+    Reply: 3600,
+    Info: 3600,
+    Messages: 86400,
+}
+
+
+def set_cached_model(m, pipe=None):
     """
-    根据Info id 返回 Info 对象。
-    如果缓存命中，则从缓存中拉取包含Info信息的字典，使用get_model得到Info对象。
-    如果缓存穿透，则从数据库查询，拿到数据后将数据序列化后存储到redis。
+    写操作之后直接用新的 model 覆盖缓存，而不是删除缓存让下一个读者去查数据库。
+    redis 不可用期间写缓存的命令会被跳过，改成删除，不能留下旧数据。
     """
-    key = 'info_id_{}.info'.format(info_id)
-    try:
-        # 拿到json 格式的数据
-        v = data_cache[key]
-    except KeyError:
-        # 如果没有缓存
-        info = Info.one(id=info_id)
-        v = json.dumps(info.json())
-        data_cache.set(key, v, 3600)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
-        return info
+    model = type(m)
+    key = cache_key(model, m.id)
+    if data_cache.breaker.is_down():
+        (pipe or data_cache).delete(key)
     else:
-        # json序列化为dict，dict生成Info对象
-        d = json.loads(v)
-        info = Info.get_model(d)
-        log('缓存命中，直接使用')
-        return info
+        (pipe or data_cache).set(key, encode(m), ex=cache_ttl[model])
 
 
-def cached_message_id2message(message_id):
+def delete_cached_models(model, ids, pipe=None):
+    """删除多个对象的缓存"""
+    if ids:
+        (pipe or data_cache).delete(*[cache_key(model, i) for i in ids])
+
+
+def list_version_key(key):
+    return '{}.version'.format(key)
+
+
+def list_version(key):
+    """重建列表缓存前调用，返回当前的版本号，传给 set_cached_list"""
+    return data_cache.get(list_version_key(key)) or b''
+
+
+def set_cached_list(key, version, ids, ttl):
+    """从数据库重建 json 数组缓存，期间有别的请求修改过列表时不写入"""
+    _set_if_version(keys=[key, list_version_key(key)], args=[version, json.dumps(ids), ttl])
+
+
+def push_cached_list(key, item, left=False, pipe=None):
     """
-    根据Message id 返回 Message 对象。
-    如果缓存命中，则从缓存中拉取包含 Message 信息的字典，使用get_model得到Message对象。
-    如果缓存穿透，则从数据库查询，拿到数据后将数据序列化后存储到redis。
+    在缓存的 json 数组中加入一个元素，
+    例如新私信的 id 加到 'user_id_{}.received_message' 的开头(left 为 True)。
     """
-    key = 'message_id_{}.message'.format(message_id)
+    _push_json_item(keys=[key, list_version_key(key)],
+                    args=[json.dumps(item), 'left' if left else 'right', list_version_ttl],
+                    client=pipe or data_cache)
+
+
+def delete_cached_list(key, pipe=None):
+    """删除列表缓存，同时增加版本号，正在重建的请求不会把删除前的数据写回去"""
+    p = pipe or data_cache.pipeline(transaction=False)
+    p.delete(key)
+    p.incr(list_version_key(key))
+    p.expire(list_version_key(key), list_version_ttl)
+    if pipe is None:
+        p.execute()
+
+
+def cached_model(model, id, name):
+    """
+    根据 id 返回 model 对应的只读对象，数据库中不存在时返回 None。
+    如果缓存命中，把缓存中的数据解码成 ModelView。
+    如果缓存穿透，则从数据库查询，拿到数据后编码存储到redis，返回数据库中查出的对象。
+    """
+    key = cache_key(model, id)
+    v = data_cache.get(key)
+    if v is not None:
+        cache_stat(name, True)
+        return decode(model, v)
+
+    m = model.one(id=id)
+    if m is not None:
+        set_cached_model(m)
+    cache_stat(name, False)
+    return m
+
+
+def cached_user_id2user(user_id):
+    """根据user id 返回 User 对象，先查进程内缓存，再查 redis，最后查数据库"""
     try:
-        # 拿到json 格式的数据
-        v = data_cache[key]
-    except KeyError:
-        # 如果没有缓存
-        message = Messages.one(id=message_id)
-        v = json.dumps(message.json())
-        data_cache.set(key, v)
-        log('缓存miss，向数据库拉取数据，重建缓存')
-        return message
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    u = local_users.get(user_id)
+    if u is None:
+        u = cached_model(User, user_id, 'user')
+        if u is not None:
+            u = as_view(u)
+            local_users.set(user_id, u)
+    return u
+
+
+def cached_ids2models(model, ids, name):
+    """
+    根据多个 id 批量返回 model 对象的列表，顺序和 ids 一致，数据库中不存在的 id 会被跳过。
+    一次 MGET 拿到所有已缓存的对象，缓存未命中的 id 用一条 WHERE id IN (...) 查询从数据库拉取，
+    再用一个 pipeline 写回缓存。
+    """
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    unique_ids = list(dict.fromkeys(ids))
+    keys = [cache_key(model, i) for i in unique_ids]
+    models = {}
+    missed_ids = []
+    for i, v in zip(unique_ids, data_cache.mget(keys)):
+        if v is None:
+            missed_ids.append(i)
+        else:
+            models[i] = decode(model, v)
+    cache_stat(name, True, len(unique_ids) - len(missed_ids))
+
+    if missed_ids:
+        with data_cache.pipeline(transaction=False) as pipe:
+            for m in model.query.filter(model.id.in_(missed_ids)):
+                models[m.id] = m
+                set_cached_model(m, pipe)
+            pipe.execute()
+        cache_stat(name, False, len(missed_ids))
+    return [models[i] for i in ids if i in models]
+
+
+def cached_user_ids2users(user_ids):
+    """根据多个user id 批量返回 {user_id: User对象}，进程内缓存中没有的再批量查 redis 和数据库"""
+    users = {}
+    missed_ids = []
+    for i in user_ids:
+        i = int(i)
+        u = local_users.get(i)
+        if u is None:
+            missed_ids.append(i)
+        else:
+            users[i] = u
+    for u in cached_ids2models(User, missed_ids, 'user'):
+        u = as_view(u)
+        local_users.set(u.id, u)
+        users[u.id] = u
+    return users
+
+
+def cached_boards():
+    """
+    所有版块，每个页面都要用到而且几乎不会修改，只缓存在进程内，过期后直接查一次数据库。
+    后台修改版块后由 model_changed 通知所有 worker。
+    """
+    boards = local_boards.get('all')
+    if boards is None:
+        boards = [as_view(b) for b in Board.all()]
+        local_boards.set('all', boards)
+    return boards
+
+
+def cached_board_id2board(board_id):
+    for b in cached_boards():
+        if b.id == board_id:
+            return b
+
+
+def model_changed(m):
+    """
+    在数据库中修改或新建对象后调用：覆盖 redis 中的缓存，并通知所有 worker 清理进程内缓存。
+    用户修改资料、头像，后台修改数据都走这里。
+    """
+    model = type(m)
+    with data_cache.pipeline(transaction=False) as pipe:
+        if model in cache_ttl:
+            set_cached_model(m, pipe)
+        if model is Reply:
+            delete_cached_list(replies_key(m.topic_id), pipe)
+        if model is User:
+            local_users.invalidate(m.id, pipe)
+        elif model is Board:
+            local_boards.invalidate(pipe=pipe)
+        pipe.execute()
+
+
+def model_deleted(m):
+    """在数据库中删除对象后调用，清理 redis 和所有 worker 进程内的缓存"""
+    model = type(m)
+    with data_cache.pipeline(transaction=False) as pipe:
+        if model in cache_ttl:
+            delete_cached_models(model, [m.id], pipe)
+        if model is Reply:
+            delete_cached_list(replies_key(m.topic_id), pipe)
+        if model is User:
+            local_users.invalidate(m.id, pipe)
+        elif model is Board:
+            local_boards.invalidate(pipe=pipe)
+        pipe.execute()
+
+
+def cached_topic_id2topic(topic_id):
+    """
+    根据topic_id 返回对应的Topic 对象，话题不存在时返回 None。
+    话题会被很多请求同时访问，缓存未命中时由 single_flight 让一个请求从数据库查询并写回缓存。
+    """
+    key = cache_key(Topic, topic_id)
+
+    def read():
+        v = data_cache.get(key)
+        if v is not None:
+            return decode(Topic, v)
+
+    def load():
+        topic = Topic.one(id=topic_id)
+        if topic is not None:
+            set_cached_model(topic)
+        return topic
+
+    topic = read()
+    if topic is not None:
+        cache_stat('topic', True)
+        return topic
+    cache_stat('topic', False)
+    return single_flight(key, load, read)
+
+
+def refresh_cached_topic(topic_id):
+    """
+    话题在数据库中更新后调用，直接用数据库中的新数据覆盖缓存，返回新的Topic对象。
+    不是删除缓存，避免下一批读者同时缓存未命中。
+    """
+    topic = Topic.one(id=topic_id)
+    if topic is None:
+        delete_cached_models(Topic, [topic_id])
     else:
-        # json序列化为dict，dict生成Info对象
-        d = json.loads(v)
-        message = Messages.get_model(d)
-        log('缓存命中，直接使用')
-        return message
+        set_cached_model(topic)
+    return topic
+
+
+def cached_reply_id2reply(reply_id):
+    """根据reply id 返回 Reply 对象"""
+    return cached_model(Reply, reply_id, 'reply')
+
+
+def cached_info_id2info(info_id):
+    """根据Info id 返回 Info 对象"""
+    return cached_model(Info, info_id, 'info')
+
+
+def cached_message_id2message(message_id):
+    """根据Message id 返回 Message 对象"""
+    return cached_model(Messages, message_id, 'message')
+
+
+def cached_topic_ids2topics(topic_ids):
+    """根据多个topic id 批量返回Topic对象列表，顺序和 topic_ids 一致"""
+    return cached_ids2models(Topic, topic_ids, 'topic')
+
+
+def cached_info_ids2infos(info_ids):
+    """根据多个info id 批量返回Info对象列表，顺序和 info_ids 一致"""
+    return cached_ids2models(Info, info_ids, 'info')
+
+
+def cached_message_ids2messages(message_ids):
+    """根据多个message id 批量返回Message对象列表，顺序和 message_ids 一致"""
+    return cached_ids2models(Messages, message_ids, 'message')
 
 
 def cached_created_topics(user_id):
     """
     根据user id 返回该用户创建的Topic对象。
 
-    如果缓存命中，则从缓存中拉取包含多个Topic id的列表，根据每个Topic id调用cached_topic_id2topic得到Topic对象。
+    如果缓存命中，则从缓存中拉取包含多个Topic id的列表，调用cached_topic_ids2topics批量得到Topic对象。
     如果缓存穿透，则从数据库查询，拿到多个Topic对象，将所有Topic id 序列化后存储到redis，返回多个Topic对象。
     """
     key = 'user_id_{}.created_topics'.format(user_id)
@@ -153,17 +559,18 @@ def cached_created_topics(user_id):
         topic_ids_json = data_cache[key]
     except KeyError:
         # 缓存未命中，数据库中拉取数据
+        version = list_version(key)
         topics_models = list(Topic.all(user_id=user_id))
         topics_models.sort(key=lambda x: x.last_active_time, reverse=True)
         # 加到redis缓存中的是topic id
-        data_cache.set(key, json.dumps([t.id for t in topics_models]), 3600)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
+        set_cached_list(key, version, [t.id for t in topics_models], 3600)
+        cache_stat('created_topics', False)
         return topics_models
     else:
-        # 从缓存中拿到多个Topic id，每个Topic id使用 cached_topic_id2topic获得Topic 对象并返回。
-        topics_models = [cached_topic_id2topic(topic_id) for topic_id in json.loads(topic_ids_json)]
+        # 从缓存中拿到多个Topic id，使用 cached_topic_ids2topics 批量获得Topic 对象并返回。
+        topics_models = cached_topic_ids2topics(json.loads(topic_ids_json))
         topics_models.sort(key=lambda x: x.last_active_time, reverse=True)
-        log('缓存命中，直接使用')
+        cache_stat('created_topics', True)
         return topics_models
 
 
@@ -171,7 +578,7 @@ def cached_replied_topics(user_id):
     """
     根据user id 返回该用户回复的Topic对象。
 
-    如果缓存命中，从缓存中拉取包含多个Topic id的列表，根据每个Topic id调用cached_topic_id2topic得到Topic model。
+    如果缓存命中，从缓存中拉取包含多个Topic id的列表，调用cached_topic_ids2topics批量得到Topic model。
     如果缓存穿透，则从数据库查询，拿到多个Topic对象，将所有Topic id 序列化后存储到redis，返回多个Topic对象。
     """
     key = 'user_id_{}.replied_topics'.format(user_id)
@@ -180,48 +587,77 @@ def cached_replied_topics(user_id):
         topics_ids_json = data_cache[key]
     except KeyError:
         # 缓存未命中，数据库中拉取数据
-        # ORM 的n+1老问题。。。
+        # topic 用 cached_topic_ids2topics 批量获取，避免 ORM 的n+1老问题
+        version = list_version(key)
         replies = list(Reply.all(user_id=user_id))
         topics_ids = [reply.topic_id for reply in replies]
         # 加到redis缓存中的是topic id
-        data_cache.set(key, json.dumps(topics_ids), 1800)
-        topics_models = [cached_topic_id2topic(topic_id) for topic_id in topics_ids]
+        set_cached_list(key, version, topics_ids, 1800)
+        topics_models = cached_topic_ids2topics(topics_ids)
         topics_models.sort(key=lambda x: x.last_active_time, reverse=True)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
+        cache_stat('replied_topics', False)
         return topics_models
     else:
-        # 缓存命中则根据缓存中的多个Topic id，再调用 cached_topic_id2topic 获得多个Topic对象，排序后返回。
-        topics_models = [cached_topic_id2topic(topic_id) for topic_id in json.loads(topics_ids_json)]
+        # 缓存命中则根据缓存中的多个Topic id，再调用 cached_topic_ids2topics 批量获得多个Topic对象，排序后返回。
+        topics_models = cached_topic_ids2topics(json.loads(topics_ids_json))
         topics_models.sort(key=lambda x: x.last_active_time, reverse=True)
-        log('缓存命中，直接使用')
+        cache_stat('replied_topics', True)
         return topics_models
 
 
+def replies_key(topic_id):
+    """话题所有回复的缓存 key，是一个 redis 的 list，第一个元素是 replies_sentinel，之后每个元素是一条编码后的回复"""
+    return 'topic_id_{}.replies.{}'.format(topic_id, model_version(Reply))
+
+
+# 没有回复的话题也要能缓存，list 中总是先放一个空字符串占位
+replies_sentinel = b''
+
+
 def cached_replies_by_topic_id(topic_id):
     """
-    根据Topic id ,返回属于该Topic的所有Reply对象。
+    根据Topic id ,返回属于该Topic的所有Reply对象，按发表时间排序。
 
-    如果缓存命中，从缓存中拿到包含了多个字典的列表，每个字典都生成一个对应的Reply对象。
-    如果缓存穿透，从数据库中查询，拿到多个Reply对象，将每个Reply经json序列化后建立缓存。
+    如果缓存命中，从缓存的 list 中拿到所有回复，解码成只读对象。
+    如果缓存穿透，由 single_flight 让一个请求从数据库中查询，拿到多个Reply对象，编码后建立缓存。
+    新回复由 push_cached_reply 直接加到缓存的结尾。
     """
-    key = 'topic_id_{}.replies'.format(topic_id)
-    try:
-        # 缓存命中
-        replies_json = data_cache[key]
-    except KeyError:
-        # 缓存未命中，数据库中拉取数据
+    key = replies_key(topic_id)
+
+    def read():
+        values = data_cache.lrange(key, 0, -1)
+        if values:
+            return [decode(Reply, v) for v in values[1:]]
+
+    def load():
+        version = list_version(key)
         replies = list(Reply.all(topic_id=topic_id))
         replies.sort(key=lambda x: x.created_time)
-        # 数据库中拿到的数据json序列化后建立缓存，一个Reply对应一个字典
-        data_cache.set(key, json.dumps([r.json() for r in replies]), 900)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
+        # 在一个脚本中重建，其他请求不会读到只写了一半的 list；期间有新回复时不写入
+        _rebuild_list_if_version(keys=[key, list_version_key(key)],
+                                 args=[version, 900, replies_sentinel] + [encode(r) for r in replies])
         return replies
-    else:
-        # 反序列化后得到字典，使用字典生成Reply对象
-        replies = [Reply.get_model(r) for r in json.loads(replies_json)]
-        replies.sort(key=lambda x: x.created_time)
-        log('缓存命中，直接使用')
+
+    replies = read()
+    if replies is not None:
+        cache_stat('replies', True)
         return replies
+    cache_stat('replies', False)
+    return single_flight(key, load, read)
+
+
+def push_cached_reply(reply, pipe=None):
+    """
+    新回复加到回复列表缓存的结尾，缓存不存在时不写入，RPUSHX 保留原来的过期时间。
+    同时增加版本号，正在重建的请求不会写入缺少这条回复的 list。
+    """
+    key = replies_key(reply.topic_id)
+    p = pipe or data_cache.pipeline(transaction=False)
+    p.rpushx(key, encode(reply))
+    p.incr(list_version_key(key))
+    p.expire(list_version_key(key), list_version_ttl)
+    if pipe is None:
+        p.execute()
 
 
 def cached_received_info(user_id):
@@ -232,16 +668,17 @@ def cached_received_info(user_id):
         info_ids_json = data_cache[key]
     except KeyError:
         # 缓存未命中，数据库中拉取数据model
+        version = list_version(key)
         info_models = list(Info.all(receiver_id=user_id))
         info_models.sort(key=lambda x: x.created_time, reverse=True)
         # 加到redis缓存中的是id
-        data_cache.set(key, json.dumps([i.id for i in info_models]), 3600)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
+        set_cached_list(key, version, [i.id for i in info_models], 3600)
+        cache_stat('received_info', False)
         return info_models
     else:
         # 从缓存中拿到多个Info id
-        info_models = [cached_info_id2info(info_id) for info_id in json.loads(info_ids_json)]
-        log('缓存命中，直接使用')
+        info_models = cached_info_ids2infos(json.loads(info_ids_json))
+        cache_stat('received_info', True)
         return info_models
 
 
@@ -253,16 +690,17 @@ def cached_received_message(user_id):
         message_ids_json = data_cache[key]
     except KeyError:
         # 缓存未命中，数据库中拉取数据model
+        version = list_version(key)
         message_models = list(Messages.all(receiver_id=user_id))
         message_models.sort(key=lambda x: x.created_time, reverse=True)
         # 加到redis缓存中的是id
-        data_cache.set(key, json.dumps([m.id for m in message_models]), 3600)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
+        set_cached_list(key, version, [m.id for m in message_models], 3600)
+        cache_stat('received_message', False)
         return message_models
     else:
         # 从缓存中拿到多个Message id
-        message_models = [cached_message_id2message(message_id) for message_id in json.loads(message_ids_json)]
-        log('缓存命中，直接使用')
+        message_models = cached_message_ids2messages(json.loads(message_ids_json))
+        cache_stat('received_message', True)
         return message_models
 
 
@@ -274,14 +712,156 @@ def cached_sent_message(user_id):
         message_ids_json = data_cache[key]
     except KeyError:
         # 缓存未命中，数据库中拉取数据model
+        version = list_version(key)
         message_models = list(Messages.all(sender_id=user_id))
         message_models.sort(key=lambda x: x.created_time, reverse=True)
         # 加到redis缓存中的是id
-        data_cache.set(key, json.dumps([m.id for m in message_models]), 3600)
-        log('缓存丢失，向数据库拉取数据，重建缓存')
+        set_cached_list(key, version, [m.id for m in message_models], 3600)
+        cache_stat('sent_message', False)
         return message_models
     else:
         # 从缓存中拿到多个Message id
-        message_models = [cached_message_id2message(message_id) for message_id in json.loads(message_ids_json)]
-        log('缓存命中，直接使用')
+        message_models = cached_message_ids2messages(json.loads(message_ids_json))
+        cache_stat('sent_message', True)
         return message_models
+
+
+# 话题浏览数先累加在 redis 的 hash 中，field 是 topic id，value 是还没写回数据库的浏览数
+topic_views_key = 'topic_views'
+flushing_topic_views_key = 'topic_views.flushing'
+
+
+def hit_topic_views(topic_id):
+    """
+    记录一次话题浏览，返回该话题还没写回数据库的浏览数，加上数据库/缓存中的 views 就是实时浏览数。
+    正在写回中的部分也要算上，避免写回期间浏览数看起来变少。
+    """
+    # redis 不可用时这次浏览不计数，页面照常显示，和 data_cache 共用一个断路器，不会每次都等待超时
+    if data_cache.breaker.is_down():
+        return 0
+    try:
+        with views_cache.pipeline(transaction=False) as pipe:
+            pipe.hincrby(topic_views_key, topic_id, 1)
+            pipe.hget(flushing_topic_views_key, topic_id)
+            pending, flushing = pipe.execute()
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        data_cache.breaker.trip(e)
+        return 0
+    return pending + int(flushing or 0)
+
+
+def flush_topic_views():
+    """
+    把 redis 中累计的浏览数批量写回数据库，返回写回的话题个数。
+    先把 hash 改名再处理，写回期间新的浏览会累加到新的 hash 中，不会丢失。
+    如果上次写回中途失败，改名后的 hash 还在，这次会先把它写回。
+    浏览数只存在 redis 中，用 views_cache 访问，redis 出错时抛出异常放弃这一轮，不会删掉还没写回的浏览数。
+    """
+    if not views_cache.exists(flushing_topic_views_key):
+        try:
+            views_cache.rename(topic_views_key, flushing_topic_views_key)
+        except redis.ResponseError:
+            # 这段时间没有新的浏览
+            return 0
+
+    pending = views_cache.hgetall(flushing_topic_views_key)
+    views = {int(k): int(v) for k, v in pending.items()}
+    Topic.add_views(views)
+    # 数据库已经提交，再删除写回中的 hash
+    views_cache.delete(flushing_topic_views_key)
+
+    # 缓存中的话题 views 已经过时，用一条 IN 查询拿到新数据覆盖缓存
+    if views:
+        with data_cache.pipeline(transaction=False) as pipe:
+            for t in Topic.query.filter(Topic.id.in_(list(views))):
+                set_cached_model(t, pipe)
+            pipe.execute()
+    return len(views)
+
+
+# 每个用户一个 hash 记录未读数，field 是 'message' 或 'info'
+unread_models = dict(
+    message=Messages,
+    info=Info,
+)
+# 计数只在已经存在时才增减，不存在时等下次读取再从数据库重建，避免从 0 开始计数
+_incr_existing_field = data_cache.register_script("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+# hash 存在时才设置字段，保留原来的过期时间
+_set_existing_hash_field = data_cache.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+
+def unread_count(user_id, kind):
+    """
+    返回用户未读私信(kind 为 'message')或系统通知(kind 为 'info')的条数。
+    计数缓存在 redis 中，丢失时从数据库 count 一次重建。
+    """
+    key = 'user_id_{}.unread'.format(user_id)
+    v = data_cache.hget(key, kind)
+    if v is not None:
+        cache_stat('unread', True)
+        return int(v)
+
+    model = unread_models[kind]
+    n = model.query.filter_by(receiver_id=user_id, been_read=False).count()
+    with data_cache.pipeline(transaction=False) as pipe:
+        pipe.hsetnx(key, kind, n)
+        # 计数出现偏差时，过期后会自动从数据库重建
+        pipe.expire(key, 86400)
+        pipe.execute()
+    cache_stat('unread', False)
+    return n
+
+
+def incr_unread(user_id, kind, n=1, pipe=None):
+    """未读数加 n，n 可以是负数。传入 pipe 时命令放到 pipeline 中执行"""
+    key = 'user_id_{}.unread'.format(user_id)
+    _incr_existing_field(keys=[key], args=[kind, n], client=pipe or data_cache)
+
+
+def clear_unread(user_id, kind, pipe=None):
+    """
+    全部标记为已读后，未读数直接置为 0。
+    hash 不存在时什么都不做，下次读取时从数据库重建，不能新建一个没有过期时间的 hash。
+    """
+    key = 'user_id_{}.unread'.format(user_id)
+    _set_existing_hash_field(keys=[key], args=[kind, 0], client=pipe or data_cache)
+
+
+# 全文搜索的结果缓存这么多秒，新发的帖子最多晚这么久出现在搜索结果中
+search_cache_ttl = 60
+# 文档总数和平均长度变化很慢，缓存更久
+search_stats_ttl = 600
+search_stats_key = 'search.corpus_stats'
+
+
+def cached_search(query, board_id, page, n):
+    """SearchDoc.search 的缓存版本，同样返回 (本页的 topic id 列表, 命中的话题总数)"""
+    s = json.dumps([query, board_id, page, n], ensure_ascii=False)
+    key = 'search.result.{}'.format(hashlib.sha1(s.encode('utf-8')).hexdigest())
+    v = data_cache.get(key)
+    if v is not None:
+        cache_stat('search', True)
+        topic_ids, total = json.loads(v)
+        return topic_ids, total
+
+    v = data_cache.get(search_stats_key)
+    if v is None:
+        stats = SearchDoc.corpus_stats()
+        # 索引还是空的(例如刚上线还没 reindex)时不缓存
+        if stats[0]:
+            data_cache.set(search_stats_key, json.dumps(stats), search_stats_ttl)
+    else:
+        stats = json.loads(v)
+    topic_ids, total = SearchDoc.search(query, board_id, page, n, stats=stats)
+    data_cache.set(key, json.dumps([topic_ids, total]), search_cache_ttl)
+    cache_stat('search', False)
+    return topic_ids, total
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+
+from flask import g, request, has_request_context, current_app
+from flask_admin import BaseView, expose
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from routes.local_cache import local_cache_stats
+from routes.myredis import user_identify_cache, data_cache, views_cache
+from utils import log, cache_stat_listeners
+
+# 超过这个耗时的请求写一条慢请求日志，单位毫秒
+slow_request_ms = 500
+# 每个 endpoint 保留最近多少次请求的耗时，用来算分位数
+stats_samples = 1000
+# 每个 worker 隔多久把自己的统计写到 redis 一次，单位秒，/admin 中的统计页面汇总所有 worker
+stats_push_interval = 30
+stats_key = 'request_stats.{}'
+local_cache_stats_key = 'local_cache_stats.{}'
+
+_installed = False
+_last_push = 0
+_stats = defaultdict(lambda: dict(
+    latency=deque(maxlen=stats_samples),
+    requests=0,
+    sql=0,
+    redis=0,
+    cache_hit=0,
+    cache_miss=0,
+))
+
+
+def _add(name, n=1, ms=0.0):
+    """把一次 SQL / redis / 缓存查询记到当前请求上，不在请求中时忽略"""
+    if has_request_context() and 'profile' in g:
+        p = g.profile
+        p[name] += n
+        p[name + '_ms'] += ms
+
+
+def _before_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_begin', []).append(time.perf_counter())
+
+
+def _after_sql(conn, cursor, statement, parameters, context, executemany):
+    begin = conn.info['query_begin'].pop()
+    _add('sql', ms=(time.perf_counter() - begin) * 1000)
+
+
+def _profile_redis(client):
+    """统计 redis 的往返次数和耗时，一次 pipeline.execute 算一次往返"""
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def profiled_command(*args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return execute_command(*args, **kwargs)
+        finally:
+            _add('redis', ms=(time.perf_counter() - begin) * 1000)
+
+    def profiled_pipeline(*args, **kwargs):
+        p = pipeline(*args, **kwargs)
+        execute = p.execute
+
+        def profiled_execute(*a, **kw):
+            begin = time.perf_counter()
+            try:
+                return execute(*a, **kw)
+            finally:
+                _add('redis', ms=(time.perf_counter() - begin) * 1000)
+
+        p.execute = profiled_execute
+        return p
+
+    client.execute_command = profiled_command
+    client.pipeline = profiled_pipeline
+
+
+def _on_cache_stat(name, hit, n):
+    _add('cache_hit' if hit else 'cache_miss', n)
+
+
+def _before_request():
+    g.profile = defaultdict(float)
+    g.request_begin = time.perf_counter()
+
+
+def _after_request(response):
+    p = g.get('profile')
+    if p is None:
+        return response
+    ms = (time.perf_counter() - g.request_begin) * 1000
+    endpoint = request.endpoint or 'unknown'
+
+    s = _stats[endpoint]
+    s['latency'].append(ms)
+    s['requests'] += 1
+    for k in ('sql', 'redis', 'cache_hit', 'cache_miss'):
+        s[k] += int(p[k])
+
+    if current_app.debug:
+        response.headers['X-Request-Time'] = '{:.1f}'.format(ms)
+        response.headers['X-SQL-Count'] = str(int(p['sql']))
+        response.headers['X-SQL-Time'] = '{:.1f}'.format(p['sql_ms'])
+        response.headers['X-Redis-Count'] = str(int(p['redis']))
+        response.headers['X-Redis-Time'] = '{:.1f}'.format(p['redis_ms'])
+
+    if ms >= slow_request_ms:
+        record = dict(
+            slow_request=endpoint,
+            method=request.method,
+            path=request.full_path,
+            status=response.status_code,
+            ms=round(ms, 1),
+            sql=int(p['sql']),
+            sql_ms=round(p['sql_ms'], 1),
+            redis=int(p['redis']),
+            redis_ms=round(p['redis_ms'], 1),
+            cache_hit=int(p['cache_hit']),
+            cache_miss=int(p['cache_miss']),
+        )
+        log(json.dumps(record, ensure_ascii=False), level=logging.WARNING)
+
+    push_stats()
+    return response
+
+
+def push_stats(force=False):
+    """把本 worker 的统计写到 redis，过期时间足够长，worker 重启后旧数据自然消失"""
+    global _last_push
+    now = time.time()
+    if not force and now - _last_push < stats_push_interval:
+        return
+    _last_push = now
+    d = {k: dict(v, latency=list(v['latency'])) for k, v in _stats.items()}
+    with data_cache.pipeline(transaction=False) as pipe:
+        pipe.set(stats_key.format(os.getpid()), json.dumps(d), 10 * stats_push_interval)
+        pipe.set(local_cache_stats_key.format(os.getpid()), json.dumps(local_cache_stats()), 10 * stats_push_interval)
+        pipe.execute()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    i = int(round(p / 100 * (len(values) - 1)))
+    return values[i]
+
+
+def endpoint_report():
+    """汇总所有 worker 的统计，返回每个 endpoint 一行，按 p99 从高到低排序"""
+    push_stats(force=True)
+    merged = defaultdict(lambda: dict(latency=[], requests=0, sql=0, redis=0, cache_hit=0, cache_miss=0))
+    for key in data_cache.scan_iter(stats_key.format('*')):
+        v = data_cache.get(key)
+        if v is None:
+            continue
+        for endpoint, s in json.loads(v).items():
+            m = merged[endpoint]
+            m['latency'].extend(s['latency'])
+            for k in ('requests', 'sql', 'redis', 'cache_hit', 'cache_miss'):
+                m[k] += s[k]
+
+    rows = []
+    for endpoint, m in merged.items():
+        if not m['latency']:
+            continue
+        n = m['requests']
+        cache_total = m['cache_hit'] + m['cache_miss']
+        rows.append(dict(
+            endpoint=endpoint,
+            requests=n,
+            p50=percentile(m['latency'], 50),
+            p99=percentile(m['latency'], 99),
+            sql=m['sql'] / n,
+            redis=m['redis'] / n,
+            cache_hit_ratio=m['cache_hit'] / cache_total if cache_total else None,
+        ))
+    rows.sort(key=lambda r: r['p99'], reverse=True)
+    return rows
+
+
+def local_cache_report():
+    """汇总所有 worker 的进程内缓存统计，每个缓存一行"""
+    merged = {}
+    for key in data_cache.scan_iter(local_cache_stats_key.format('*')):
+        v = data_cache.get(key)
+        if v is None:
+            continue
+        for s in json.loads(v):
+            m = merged.setdefault(s['name'], dict(name=s['name'], workers=0, size=0, hits=0, misses=0, evictions=0))
+            m['workers'] += 1
+            for k in ('size', 'hits', 'misses', 'evictions'):
+                m[k] += s[k]
+
+    rows = list(merged.values())
+    for r in rows:
+        total = r['hits'] + r['misses']
+        r['hit_ratio'] = r['hits'] / total if total else None
+    rows.sort(key=lambda r: r['name'])
+    return rows
+
+
+class RequestStatsView(BaseView):
+    """/admin 中的请求统计页面"""
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/request_stats.html',
+                           rows=endpoint_report(),
+                           local_cache_rows=local_cache_report(),
+                           slow_request_ms=slow_request_ms,
+                           )
+
+
+def init_profiler(app):
+    """
+    统计每个请求的 SQL 条数和耗时、redis 往返次数和耗时、缓存命中数。
+    debug 模式下写到响应头，慢请求写一条 json 日志，并按 endpoint 汇总给 /admin 的统计页面。
+    """
+    global _installed
+    if not _installed:
+        _installed = True
+        event.listen(Engine, 'before_cursor_execute', _before_sql)
+        event.listen(Engine, 'after_cursor_execute', _after_sql)
+        _profile_redis(user_identify_cache)
+        _profile_redis(data_cache)
+        _profile_redis(views_cache)
+        cache_stat_listeners.append(_on_cache_stat)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
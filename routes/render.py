@@ -0,0 +1,127 @@
+import hashlib
+import json
+import re
+import xml.etree.ElementTree as etree
+from functools import lru_cache
+
+import bleach
+import markdown
+from markdown.extensions import Extension
+from markdown.inlinepatterns import InlineProcessor
+from markdown.util import AtomicString
+
+from routes.myredis import data_cache
+from utils import cache_stat
+
+# 为 True 时话题和回复在服务器端渲染成 html，详情页不再加载 marked 在浏览器中渲染
+server_side_markdown = True
+# 渲染好的 html 按内容的 hash 缓存，内容修改后 key 自然变化
+markdown_cache_ttl = 86400
+# 渲染规则改变时加一，之前缓存的 html 不再使用
+markdown_cache_version = 2
+
+markdown_extensions = ['extra', 'codehilite', 'sane_lists']
+markdown_extension_configs = {
+    # 代码高亮由 pygments 在服务器端完成，样式在 static/css/highlight.css
+    'codehilite': {'css_class': 'highlight', 'guess_lang': False},
+}
+allowed_tags = [
+    'p', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'strong', 'em', 'b', 'i', 'del', 'code', 'pre', 'blockquote',
+    'ul', 'ol', 'li', 'a', 'img', 'span', 'div',
+    'table', 'thead', 'tbody', 'tr', 'th', 'td',
+]
+allowed_attributes = {
+    'a': ['href', 'title'],
+    'img': ['src', 'alt', 'title'],
+    'span': ['class'],
+    'div': ['class'],
+    'code': ['class'],
+    'pre': ['class'],
+    'th': ['align'],
+    'td': ['align'],
+}
+
+
+@lru_cache(maxsize=1024)
+def mention_pattern(names):
+    """names 是被 @ 的用户名的元组，长的名字排在前面，避免 @gua 抢先匹配了 @guagua"""
+    names = sorted(names, key=len, reverse=True)
+    return re.compile('@({})'.format('|'.join(re.escape(n) for n in names)))
+
+
+def content_with_mentions(content, mentions):
+    """mentions 是 {用户名: user id}，把正文中的 @用户名 替换成指向用户主页的链接，只扫描一遍"""
+    if not mentions:
+        return content
+
+    def link(m):
+        name = m.group(1)
+        return '<a href="/user/{}">@{}</a>'.format(mentions[name], name)
+
+    return mention_pattern(tuple(mentions)).sub(link, content)
+
+
+class _MentionProcessor(InlineProcessor):
+    """把 @用户名 替换成链接，作为 markdown 的行内规则，代码块和行内代码中的 @用户名 保持原样"""
+
+    def __init__(self, mentions):
+        super().__init__(mention_pattern(tuple(mentions)).pattern)
+        self.mentions = mentions
+
+    def handleMatch(self, m, data):
+        name = m.group(1)
+        a = etree.Element('a')
+        a.set('href', '/user/{}'.format(self.mentions[name]))
+        # 用户名中的 _ 和 * 不再当作强调
+        a.text = AtomicString('@' + name)
+        return a, m.start(0), m.end(0)
+
+
+class _MentionExtension(Extension):
+    def __init__(self, mentions):
+        super().__init__()
+        self.mentions = mentions
+
+    def extendMarkdown(self, md):
+        # 优先级低于行内代码(190)，行内代码先匹配，其中的 @用户名 不会被替换
+        md.inlinePatterns.register(_MentionProcessor(self.mentions), 'mention', 175)
+
+
+def render_markdown(content, mentions):
+    """markdown 转成 html，再过滤掉不在白名单中的标签和属性，防止 XSS"""
+    extensions = list(markdown_extensions)
+    if mentions:
+        extensions.append(_MentionExtension(mentions))
+    html = markdown.markdown(
+        content,
+        extensions=extensions,
+        extension_configs=markdown_extension_configs,
+    )
+    return bleach.clean(html, tags=allowed_tags, attributes=allowed_attributes, strip=True)
+
+
+def markdown_key(content, mentions):
+    s = json.dumps([content, mentions], ensure_ascii=False, sort_keys=True)
+    return 'markdown.{}.{}'.format(markdown_cache_version, hashlib.sha1(s.encode('utf-8')).hexdigest())
+
+
+def rendered_contents(items):
+    """
+    批量渲染多个 (content, mentions)，返回 html 的列表，顺序和 items 一致。
+    一次 MGET 取出已经渲染过的 html，没有缓存的渲染后用一个 pipeline 写回。
+    """
+    if not items:
+        return []
+    keys = [markdown_key(content, mentions) for content, mentions in items]
+    htmls = [None if v is None else v.decode('utf-8') for v in data_cache.mget(keys)]
+    missed = [i for i, h in enumerate(htmls) if h is None]
+    cache_stat('markdown', True, len(items) - len(missed))
+    if missed:
+        with data_cache.pipeline(transaction=False) as pipe:
+            for i in missed:
+                htmls[i] = render_markdown(*items[i])
+                pipe.set(keys[i], htmls[i], markdown_cache_ttl)
+            pipe.execute()
+        cache_stat('markdown', False, len(missed))
+    return htmls
@@ -0,0 +1,33 @@
+from flask import (render_template,
+                   request,
+                   Blueprint,
+                   )
+
+from routes import current_user, topic_cells
+from routes.myredis import cached_topic_ids2topics, cached_boards, cached_search
+
+main = Blueprint('search', __name__)
+
+search_page_size = 20
+
+
+@main.route('/')
+def index():
+    """全文搜索话题和回复，按相关度排序，可以按板块过滤，按页码翻页"""
+    q = request.args.get('q', '').strip()
+    board_id = request.args.get('board_id', -1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    topic_ids, total = cached_search(q, board_id, page, search_page_size)
+    topics = cached_topic_ids2topics(topic_ids)
+    pages = (total + search_page_size - 1) // search_page_size
+    return render_template('search/index.html',
+                           user=current_user(),
+                           q=q,
+                           current_bid=board_id,
+                           bs=cached_boards(),
+                           topics=topic_cells(topics),
+                           total=total,
+                           page=page,
+                           pages=pages,
+                           )
@@ -0,0 +1,97 @@
+import time
+import uuid
+
+from routes.myredis import user_identify_cache
+
+# 会话空闲超过这么多秒自动过期，用 redis 的 TTL 实现，每次使用时续期
+session_ttl = 3600
+# 两次续期之间至少间隔这么多秒，避免每个请求都写 redis
+session_renew_interval = 300
+# 从登录开始算，会话最多存活这么多秒，之后需要重新登录
+session_max_age = 30 * 86400
+
+# 每个会话一个 hash，field 是 uid、created(登录时间)、renewed(上次续期时间)
+session_key = 'session.{}'
+# 每个用户一个 set，保存该用户所有会话的 id，用来一次注销所有设备
+user_sessions_key = 'user_id_{}.sessions'
+
+
+def new_session(user_id):
+    """登录时调用，新建会话并返回 session id"""
+    session_id = str(uuid.uuid4())
+    now = int(time.time())
+    key = session_key.format(session_id)
+    key2 = user_sessions_key.format(user_id)
+    with user_identify_cache.pipeline() as pipe:
+        pipe.hset(key, mapping=dict(uid=user_id, created=now, renewed=now))
+        pipe.expire(key, session_ttl)
+        pipe.sadd(key2, session_id)
+        pipe.expire(key2, session_max_age)
+        pipe.execute()
+    return session_id
+
+
+def session_user_id(session_id):
+    """
+    返回会话对应的 user id，会话不存在或者已经过期时返回 None。
+    距离上次续期超过 session_renew_interval 秒时才续期，大部分请求只有一次 HMGET。
+    """
+    key = session_key.format(session_id)
+    uid, created, renewed = user_identify_cache.hmget(key, 'uid', 'created', 'renewed')
+    if uid is None or created is None or renewed is None:
+        return None
+
+    now = int(time.time())
+    remaining = int(created) + session_max_age - now
+    if remaining <= 0:
+        revoke_session(session_id)
+        return None
+    if now - int(renewed) >= session_renew_interval:
+        with user_identify_cache.pipeline(transaction=False) as pipe:
+            pipe.hset(key, 'renewed', now)
+            pipe.expire(key, min(session_ttl, remaining))
+            pipe.execute()
+    return int(uid)
+
+
+def revoke_session(session_id):
+    """注销一个会话"""
+    key = session_key.format(session_id)
+    uid = user_identify_cache.hget(key, 'uid')
+    with user_identify_cache.pipeline(transaction=False) as pipe:
+        pipe.delete(key)
+        if uid is not None:
+            pipe.srem(user_sessions_key.format(int(uid)), session_id)
+        pipe.execute()
+
+
+def revoke_user_sessions(user_id, keep=None):
+    """
+    注销用户的所有会话，返回注销的个数。
+    修改密码时 keep 传入当前的 session id，当前设备保持登录。
+    """
+    key = user_sessions_key.format(user_id)
+    session_ids = [s.decode() for s in user_identify_cache.smembers(key)]
+    revoked = [s for s in session_ids if s != keep]
+    if revoked:
+        with user_identify_cache.pipeline() as pipe:
+            pipe.delete(*[session_key.format(s) for s in revoked])
+            pipe.srem(key, *revoked)
+            pipe.execute()
+    return len(revoked)
+
+
+def active_sessions(user_id):
+    """返回用户还没有过期的会话 id，顺便把已经过期的从 set 中删掉"""
+    key = user_sessions_key.format(user_id)
+    session_ids = [s.decode() for s in user_identify_cache.smembers(key)]
+    if not session_ids:
+        return []
+    with user_identify_cache.pipeline(transaction=False) as pipe:
+        for s in session_ids:
+            pipe.exists(session_key.format(s))
+        alive = pipe.execute()
+    dead = [s for s, a in zip(session_ids, alive) if not a]
+    if dead:
+        user_identify_cache.srem(key, *dead)
+    return [s for s, a in zip(session_ids, alive) if a]
@@ -1,3 +1,4 @@
+import json
 import time
 
 from flask import (
@@ -10,24 +11,39 @@ from flask import (
     abort,
 )
 
-from sqlalchemy import desc
-from models.base_model import db
-from models.board import Board
 from routes import (current_user,
                     csrf_required,
+                    csrf_required_once,
                     new_csrf_token,
                     login_required,
                     inform_at,
                     topic_owner_required_post,
                     at_users,
+                    mentions_json,
+                    topic_cells,
                     cached_topic_id2topic,
                     )
 
+from models.reply import Reply
+from models.search import SearchDoc
 from models.topic import Topic
 from routes.myredis import (data_cache,
                             cached_replies_by_topic_id,
                             cached_user_id2user,
+                            hit_topic_views,
+                            push_cached_list,
+                            set_cached_model,
+                            delete_cached_models,
+                            replies_key,
+                            delete_cached_list,
+                            cached_boards,
+                            cached_board_id2board,
                             )
+from routes.render import (server_side_markdown,
+                           content_with_mentions,
+                           rendered_contents,
+                           markdown_key,
+                           )
 
 main = Blueprint('my_topic', __name__)
 
@@ -39,34 +55,60 @@ def get_author(topic):
     return cached_user_id2user(author_id)
 
 
+def item_mentions(item):
+    """Topic 或 Reply 中被@的用户 {用户名: user id}，发表时已经解析好存在 mentions 中"""
+    if item.mentions is None:
+        # 老数据没有 mentions，由 migrate.py 一次性回填，回填之前现场解析
+        return {u.username: u.id for u in at_users(item.content)}
+    return json.loads(item.mentions)
+
+
 @main.app_template_filter()
-def content_with_clickable_name(content: str):
-    """@功能"""
-    for n in at_users(content):
-        s = '@' + n.username
-        content = content.replace(s, '<a href="/user/{}">@{}</a>'.format(n.id, n.username))
-    return content
+def content_with_clickable_name(item):
+    """
+    @功能，item 是 Topic 或 Reply，用于浏览器端渲染 markdown 的情况。
+    渲染时只做一次正则替换，不查询数据库。
+    链接指向 user id，被@的用户改名后链接依然有效，不需要重新渲染。
+    """
+    return content_with_mentions(item.content, item_mentions(item))
+
+
+# 话题列表每页的条数
+topic_page_size = 30
+
+
+def parse_cursor(s):
+    """把 query 中 '{last_active_time}_{id}' 形式的 cursor 还原成元组，非法时返回 None"""
+    try:
+        active_time, topic_id = s.split('_')
+        return int(active_time), int(topic_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_cursor(cursor):
+    if cursor is not None:
+        return '{}_{}'.format(*cursor)
 
 
 @main.route('/')
 def index():
     """获取话题主页，每个话题cell 最后回复人的头像，
     最后变动时间，作者头像，评论数、浏览数。
-    根据query选定板块"""
+    根据query选定板块，根据cursor翻页"""
     visitor = current_user()
     board_id = int(request.args.get('board_id', -1))
     current_bid = board_id
-    if board_id == -1:
-        recent_active_topics = db.session.query(Topic).order_by(desc(Topic.last_active_time))
-    else:
-        recent_active_topics = db.session.query(Topic).filter_by(board_id=current_bid).order_by(
-            desc(Topic.last_active_time))
-    bs = Board.all()
+    cursor = parse_cursor(request.args.get('cursor'))
+    recent_active_topics, next_cursor = Topic.page(current_bid, cursor, topic_page_size)
+    bs = cached_boards()
     return render_template('topic/index.html',
-                           recent_topics=recent_active_topics,
+                           recent_topics=topic_cells(recent_active_topics),
                            current_bid=current_bid,
                            user=visitor,
                            bs=bs,
+                           is_first_page=cursor is None,
+                           next_cursor=format_cursor(next_cursor),
                            )
 
 
@@ -75,20 +117,27 @@ def detail(topic_id):
     """
     id 为Topic 的话题的详情页
     """
-    cur_topic = Topic.get(topic_id)
+    cur_topic = cached_topic_id2topic(topic_id)
     if cur_topic is None:
         return abort(404)
 
-    key = 'topic_id_{}.topic_info'.format(topic_id)
-    # 每次有人点开详情页，需要更新浏览数，故旧缓存作废
-    data_cache.delete(key)
+    # 浏览数累加在 redis 中，由 tasks.py 定期批量写回数据库，浏览详情页不再写库，也不清理缓存
+    views = cur_topic.views + hit_topic_views(cur_topic.id)
     replies = cached_replies_by_topic_id(topic_id)
-    board = Board.one(id=cur_topic.board_id)
+    htmls = []
+    if server_side_markdown:
+        # 话题和所有回复一起批量渲染，已经渲染过的内容直接从缓存中取
+        htmls = rendered_contents([(i.content, item_mentions(i)) for i in [cur_topic] + replies])
+    board = cached_board_id2board(cur_topic.board_id)
     author = cached_user_id2user(cur_topic.user_id)
     token = new_csrf_token()
     return render_template('topic/detail.html',
                            topic=cur_topic,
+                           views=views,
                            replies=replies,
+                           server_side_markdown=server_side_markdown,
+                           topic_html=htmls[0] if htmls else None,
+                           reply_htmls=htmls[1:],
                            author=author,
                            token=token,
                            board=board,
@@ -105,13 +154,16 @@ def add():
     """
     form = request.form.to_dict()
     u = current_user()
+    called_users = at_users(form['content'])
+    form['mentions'] = mentions_json(called_users)
     t = Topic.add(form, user_id=u.id)
 
-    # 新增话题后，user_id 下所有话题的缓存失效，清理旧缓存。
+    # 新话题的 id 直接加到该用户话题列表缓存的开头
     key = 'user_id_{}.created_topics'.format(u.id)
-    data_cache.delete(key)
+    push_cached_list(key, t.id, left=True)
 
-    inform_at(t, t.content, u)
+    SearchDoc.index_topic(t)
+    inform_at(t, called_users, u)
     return redirect(url_for('.detail', topic_id=t.id))
 
 
@@ -122,7 +174,7 @@ def new():
     current_bid = int(request.args.get('board_id', -1))
     token = new_csrf_token()
     u = current_user()
-    bs = Board.all()
+    bs = cached_boards()
     return render_template("topic/new.html",
                            token=token,
                            user=u,
@@ -133,7 +185,7 @@ def new():
 
 @main.route("/deletion", methods=['POST'])
 @topic_owner_required_post
-@csrf_required
+@csrf_required_once
 def delete():
     """删除某个话题，话题id从form中获取"""
     user_id = current_user().id
@@ -142,17 +194,14 @@ def delete():
     if topic is not None:
         # 删帖后，清理该帖子相关的缓存
         with data_cache.pipeline(transaction=False) as pipe:
-            key = 'topic_id_{}.topic_info'.format(i)
             key2 = 'user_id_{}.created_topics'.format(user_id)
-            key3 = 'topic_id_{}.replies'.format(topic.id)
-            pipe.delete(key)
-            pipe.delete(key2)
-            pipe.delete(key3)
+            delete_cached_models(Topic, [topic.id], pipe)
+            delete_cached_list(key2, pipe)
+            delete_cached_list(replies_key(topic.id), pipe)
 
             delete_rep_id_list = Topic.delete(topic)
-            for i in delete_rep_id_list:
-                key = 'reply_id_{}.reply_info'.format(i)
-                data_cache.delete(key)
+            SearchDoc.remove_topic(topic.id)
+            delete_cached_models(Reply, delete_rep_id_list, pipe)
             pipe.execute()
 
         flash('帖子删除成功')
@@ -167,7 +216,7 @@ def edit(topic_id):
     old_topic: Topic = cached_topic_id2topic(topic_id)
     token = new_csrf_token()
     u = current_user()
-    all_borads = Board.all()
+    all_borads = cached_boards()
 
     if u.id != old_topic.user_id:
         return abort(404)
@@ -188,7 +237,13 @@ def edit(topic_id):
 def edit_post(id):
     form = request.form.to_dict()
     now = time.time()
-    Topic.update(id, **form, last_edit_time=now, last_active_time=now)
-    key = 'topic_id_{}.topic_info'.format(id)
-    data_cache.delete(key)
+    old_topic = cached_topic_id2topic(id)
+    form['mentions'] = mentions_json(at_users(form['content']))
+    t = Topic.update(id, **form, last_edit_time=now, last_active_time=now)
+    SearchDoc.index_topic(t)
+    # 修改后的话题直接覆盖缓存
+    set_cached_model(t)
+    # 修改前内容渲染出的 html 不会再用到
+    key2 = markdown_key(old_topic.content, item_mentions(old_topic))
+    data_cache.delete(key2)
     return redirect(url_for('.detail', topic_id=id))
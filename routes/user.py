@@ -1,6 +1,3 @@
-import os
-import uuid
-
 from flask import (render_template,
                    abort,
                    request,
@@ -22,11 +19,15 @@ from routes import (login_required,
                     csrf_required,
                     cached_topic_id2topic,
                     cached_user_id2user,
+                    topic_cells,
+                    forget_current_user,
                     )
+from routes.avatar import avatar_max_bytes, check_upload, submit_avatar
 from routes.myredis import (cached_created_topics,
                             cached_replied_topics,
-                            data_cache,
+                            model_changed,
                             )
+from routes.session_store import active_sessions, revoke_user_sessions
 
 main = Blueprint('my_user', __name__)
 
@@ -49,8 +50,8 @@ def profile():
 
     return render_template('user/user_profile.html',
                            user=u,
-                           recent_rep_topics=recent_rep_topics,
-                           recent_create_topics=recent_create_topics,
+                           recent_rep_topics=topic_cells(recent_rep_topics),
+                           recent_create_topics=topic_cells(recent_create_topics),
                            visitor_id=visitor_id)
 
 
@@ -75,8 +76,8 @@ def user_detail(user_id):
         return render_template('user/user_profile.html',
                                user=u,
                                visitor=visitor,
-                               recent_rep_topics=recent_rep_topics,
-                               recent_create_topics=recent_create_topics,
+                               recent_rep_topics=topic_cells(recent_rep_topics),
+                               recent_create_topics=topic_cells(recent_create_topics),
                                )
 
 
@@ -91,7 +92,7 @@ def user_created_topics(user_id):
         topics.sort(key=lambda x: x.last_active_time, reverse=True)
         return render_template('user/user_items.html',
                                itemtype='创建',
-                               topics=topics,
+                               topics=topic_cells(topics),
                                user=u,
                                )
 
@@ -115,7 +116,7 @@ def user_replied_topics(user_id):
         topics = cached_replied_topics(user_id)
         return render_template('user/user_items.html',
                                itemtype='参与',
-                               topics=topics,
+                               topics=topic_cells(topics),
                                user=u,
                                )
 
@@ -126,7 +127,11 @@ def setting():
     """设置页面"""
     u = current_user()
     token = new_csrf_token()
-    return render_template('user/setting.html', user=u, token=token)
+    return render_template('user/setting.html',
+                           user=u,
+                           token=token,
+                           session_count=len(active_sessions(u.id)),
+                           )
 
 
 @main.route('/setting', methods=['POST'])
@@ -144,9 +149,11 @@ def setting_post():
             if len(new_pass) <= 2:
                 flash('密码强度过低，请重新输入')
             else:
-                User.update(u.id, password=User.salted_password(new_pass))
-                key = 'user_id_{}.user_info'.format(u.id)
-                data_cache.delete(key)
+                new_u = User.update(u.id, password=User.salted_password(new_pass))
+                model_changed(new_u)
+                # 其他设备上的登录全部失效，当前设备保持登录
+                revoke_user_sessions(u.id, keep=request.cookies.get('session_id'))
+                forget_current_user()
                 flash('密码修改成功')
         else:
             flash('密码错误，请重新输入')
@@ -156,16 +163,16 @@ def setting_post():
         new_name = form['name']
         if new_name != u.username:  # 如果修改了用户名，需要检测新用户名是否被占用
             if User.one(username=new_name) is None:
-                User.update(u.id, username=new_name, signature=form['signature'])
-                key = 'user_id_{}.user_info'.format(u.id)
-                data_cache.delete(key)
+                new_u = User.update(u.id, username=new_name, signature=form['signature'])
+                model_changed(new_u)
+                forget_current_user()
                 flash('个人资料修改成功')
             else:
                 flash('用户名被占用，请重新输入')
         else:  # 如果没修改用户名
-            User.update(u.id, signature=form['signature'])
-            key = 'user_id_{}.user_info'.format(u.id)
-            data_cache.delete(key)
+            new_u = User.update(u.id, signature=form['signature'])
+            model_changed(new_u)
+            forget_current_user()
             flash('个人资料修改成功')
 
     return redirect(url_for('.setting'))
@@ -175,18 +182,25 @@ def setting_post():
 @login_required
 @csrf_required
 def avatar_set():
-    """设置头像"""
+    """设置头像，只检查格式和大小，缩略图由 avatar_queue.py 的 worker 生成"""
     u = current_user()
     file: FileStorage = request.files['avatar']
-    filename = 'avatar_uid=[{}]'.format(u.id)+str(uuid.uuid4())
-    path = os.path.join('images', filename)
-    file.save(path)
-    User.update(u.id, image='/images/{}'.format(filename))
-    key = 'user_id_{}.user_info'.format(u.id)
-    data_cache.delete(key)
+    # 多读一个字节，超过上限时不会把整个文件读进内存
+    data = file.stream.read(avatar_max_bytes + 1)
+    try:
+        check_upload(data)
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('.setting'))
+
+    if not submit_avatar(u.id, data):
+        flash('头像上传成功，正在处理，稍后刷新页面即可看到新头像')
+        return redirect(url_for('.setting'))
+    forget_current_user()
     return redirect(url_for('.profile'))
 
 
-@main.route('/images/<filename>')
+@main.route('/images/<path:filename>')
 def image(filename):
+    """开发时使用，线上由 nginx 直接提供 images 目录"""
     return send_from_directory('images', filename)
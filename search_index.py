@@ -0,0 +1,122 @@
+import argparse
+import time
+from collections import Counter
+
+from sqlalchemy import tuple_, exists
+
+from app import configured_app
+from models.base_model import db
+from models.reply import Reply
+from models.search import SearchDoc, SearchPosting, SearchTerm, kind_topic, kind_reply
+from models.topic import Topic
+from utils import log, log_to_console
+
+# 每批从数据库读取和写入的行数
+chunk_size = 1000
+
+
+class _Writer(object):
+    """
+    攒够 chunk_size 个文档后批量写入。文档 id 由 MySQL 分配，写入后按 (kind, item_id) 查回来再写倒排记录，
+    重建期间网站照常运行，发帖、回帖增量写入的文档不会和这里的 id 冲突。
+    写入前给话题和回复加共享锁并跳过已经删除的，删除话题或回复的请求要等这一批 commit 之后才能删除，
+    删除之后它清理索引时会把这里写入的文档一起删掉，不会留下已经删除的内容的文档。
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.terms = {}
+        self.count = 0
+
+    def add(self, kind, item_id, topic_id, board_id, terms):
+        key = (kind, item_id)
+        self.docs[key] = dict(
+            kind=kind,
+            item_id=item_id,
+            topic_id=topic_id,
+            board_id=board_id,
+            length=len(terms),
+        )
+        self.terms[key] = terms
+        if len(self.docs) >= chunk_size:
+            self.flush()
+
+    def _doc_ids(self, keys, without_postings=False):
+        rows = db.session.query(SearchDoc.id, SearchDoc.kind, SearchDoc.item_id) \
+            .filter(tuple_(SearchDoc.kind, SearchDoc.item_id).in_(keys))
+        if without_postings:
+            rows = rows.filter(~exists().where(SearchPosting.doc_id == SearchDoc.id))
+        return {(kind, item_id): doc_id for doc_id, kind, item_id in rows}
+
+    def _live(self, keys):
+        """还没有删除的话题和回复，加共享锁直到 commit。删除话题时同一个事务中会删除它的回复，回复不用再检查所在的话题"""
+        live = set()
+        for kind, model in ((kind_topic, Topic), (kind_reply, Reply)):
+            ids = [item_id for k, item_id in keys if k == kind]
+            if ids:
+                rows = db.session.query(model.id).filter(model.id.in_(ids)).with_for_update(read=True)
+                live.update((kind, i) for i, in rows)
+        return live
+
+    def flush(self):
+        if self.docs:
+            # 重建开始后新发表的内容已经由请求建好了索引，重建开始后删除的内容不再建索引
+            existing = self._doc_ids(list(self.docs))
+            live = self._live([k for k in self.docs if k not in existing])
+            keys = [k for k in self.docs if k in live]
+            if keys:
+                # IGNORE: 查询之后、写入之前正好有请求建了同一个文档的索引时不报错。
+                # 请求在同一个事务中写入文档和倒排记录，只给还没有倒排记录的文档写，不会多写一份
+                db.session.execute(SearchDoc.__table__.insert().prefix_with('IGNORE'), [self.docs[k] for k in keys])
+                postings = []
+                for k, doc_id in self._doc_ids(keys, without_postings=True).items():
+                    postings.extend(SearchDoc.posting_rows(doc_id, self.docs[k]['board_id'], self.terms[k]))
+                if postings:
+                    db.session.execute(SearchPosting.__table__.insert(), postings)
+                    SearchTerm.change_df(Counter(p['term'] for p in postings))
+            db.session.commit()
+            self.count += len(keys)
+        self.docs = {}
+        self.terms = {}
+
+
+def reindex():
+    """
+    清空全文索引，从话题和回复表重新建立，返回文档数。
+    平时索引在发帖、回帖、编辑和删除时增量更新，这个命令用在第一次上线、修改了分词规则或者索引损坏的时候。
+    可以在网站运行时执行，重建期间搜索结果不完整，重建期间发表和删除的内容在重建完成后也是正确的。
+    """
+    begin = time.time()
+    db.session.execute(SearchPosting.__table__.delete())
+    db.session.execute(SearchTerm.__table__.delete())
+    db.session.execute(SearchDoc.__table__.delete())
+    db.session.commit()
+
+    w = _Writer()
+    topic_boards = {}
+    for t in Topic.query.order_by(Topic.id).yield_per(chunk_size):
+        topic_boards[t.id] = t.board_id
+        w.add(kind_topic, t.id, t.id, t.board_id, SearchDoc.topic_terms(t))
+    for r in Reply.query.order_by(Reply.id).yield_per(chunk_size):
+        board_id = topic_boards.get(r.topic_id)
+        # 话题已经删除的回复不建索引
+        if board_id is not None:
+            w.add(kind_reply, r.id, r.topic_id, board_id, SearchDoc.reply_terms(r))
+    w.flush()
+    log('重建全文索引', w.count, '个文档，耗时 {:.1f} 秒'.format(time.time() - begin))
+    return w.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Swordman BBS 全文索引')
+    parser.add_argument('command', choices=['reindex'], help='reindex 从数据库重建全部索引')
+    parser.parse_args()
+    log_to_console()
+
+    app = configured_app()
+    with app.app_context():
+        reindex()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import time
+from collections import Counter
+
+from routes.myredis import user_identify_cache
+from routes.session_store import (session_key,
+                                  user_sessions_key,
+                                  session_ttl,
+                                  session_max_age,
+                                  active_sessions,
+                                  )
+
+# 改成 redis TTL 之前的会话，json 格式，过期时间保存在 expired_time 中，没有 TTL
+legacy_session_pattern = 'session_id.*'
+# 每次 SCAN 取多少个 key，避免阻塞 redis
+scan_count = 1000
+
+
+def scan_legacy(compact, stats):
+    """
+    旧格式的会话：还没过期的迁移成新的 hash 格式，session id 不变，用户不需要重新登录；
+    过期的和无法解析的直接删除。
+    """
+    now = int(time.time())
+    for key in user_identify_cache.scan_iter(legacy_session_pattern, count=scan_count):
+        v = user_identify_cache.get(key)
+        try:
+            d = json.loads(v)
+            session_id = d['session_id']
+            user_id = int(d['user_id'])
+            remaining = int(d['expired_time']) - now
+        except (TypeError, ValueError, KeyError):
+            stats['legacy_invalid'] += 1
+            remaining = None
+        else:
+            stats['legacy_valid' if remaining > 0 else 'legacy_expired'] += 1
+
+        if not compact:
+            continue
+        with user_identify_cache.pipeline() as pipe:
+            if remaining is not None and remaining > 0:
+                k = session_key.format(session_id)
+                pipe.hset(k, mapping=dict(uid=user_id, created=now, renewed=now))
+                pipe.expire(k, min(session_ttl, remaining))
+                pipe.sadd(user_sessions_key.format(user_id), session_id)
+                pipe.expire(user_sessions_key.format(user_id), session_max_age)
+                stats['migrated'] += 1
+            pipe.delete(key)
+            pipe.execute()
+        stats['legacy_deleted'] += 1
+
+
+def scan_sessions(compact, stats):
+    """新格式的会话：统计个数，正常情况下都有 TTL，没有 TTL 或者缺少 uid 的是异常数据"""
+    for key in user_identify_cache.scan_iter(session_key.format('*'), count=scan_count):
+        with user_identify_cache.pipeline(transaction=False) as pipe:
+            pipe.hget(key, 'uid')
+            pipe.ttl(key)
+            uid, ttl = pipe.execute()
+        stats['sessions'] += 1
+        if uid is None:
+            stats['sessions_without_uid'] += 1
+            if compact:
+                user_identify_cache.delete(key)
+        elif ttl == -1:
+            stats['sessions_without_ttl'] += 1
+            if compact:
+                user_identify_cache.expire(key, session_ttl)
+
+
+def scan_user_sets(compact, stats):
+    """每个用户的会话 set，统计其中已经过期的会话 id，compact 时删掉"""
+    pattern = user_sessions_key.format('*')
+    for key in user_identify_cache.scan_iter(pattern, count=scan_count):
+        user_id = key.decode().split('.')[0][len('user_id_'):]
+        n = user_identify_cache.scard(key)
+        stats['user_sets'] += 1
+        stats['user_set_members'] += n
+        if compact:
+            stats['user_set_members_pruned'] += n - len(active_sessions(user_id))
+
+
+def run(compact):
+    stats = Counter()
+    scan_legacy(compact, stats)
+    scan_sessions(compact, stats)
+    scan_user_sets(compact, stats)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Swordman BBS 会话统计和清理')
+    parser.add_argument('command', choices=['report', 'compact'],
+                        help='report 只统计；compact 迁移旧格式的会话，删除过期和异常的数据')
+    args = parser.parse_args()
+
+    stats = run(args.command == 'compact')
+    for k in sorted(stats):
+        print('{:<28}{:>10}'.format(k, stats[k]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import logging
+import time
+
+from app import configured_app
+from avatar_queue import gc as avatar_gc, gc_interval
+from models.base_model import db
+from routes.myredis import flush_topic_views
+from utils import log
+
+# 浏览数写回数据库的间隔，单位秒
+view_flush_interval = 60
+
+
+def _run(name, task):
+    """执行一个任务，出错时记录日志后继续，不让一个任务的异常让整个进程退出、被 supervisor 反复重启"""
+    try:
+        return task()
+    except Exception as e:
+        log('定期任务出错', name, e, level=logging.WARNING)
+    finally:
+        db.session.remove()
+
+
+def run_periodic_tasks():
+    """后台定期任务，由 supervisor 启动的独立进程运行，不占用 web worker"""
+    app = configured_app()
+    # 启动后过 gc_interval 再第一次 gc，进程反复重启时不会每次都扫描头像目录
+    last_gc = time.time()
+    with app.app_context():
+        while True:
+            n = _run('flush_topic_views', flush_topic_views)
+            if n is not None:
+                log('浏览数写回数据库，话题数', n)
+            if time.time() - last_gc >= gc_interval:
+                last_gc = time.time()
+                _run('avatar_gc', avatar_gc)
+            time.sleep(view_flush_interval)
+
+if __name__ == '__main__':
+    run_periodic_tasks()
@@ -1,12 +1,174 @@
-import os.path
-import time
-import json
-
-
-def log(*args, **kwargs):
-    format = '%H:%M:%S'
-    value = time.localtime(int(time.time()))
-    dt = time.strftime(format, value)
-    with open('mylog.txt', 'a', encoding='utf-8') as f:
-        print(dt, *args, **kwargs)
-        print(dt, *args, file=f, **kwargs)
\ No newline at end of file
+import atexit
+import logging
+import os
+import queue
+import threading
+from collections import Counter
+from logging.handlers import RotatingFileHandler, QueueHandler
+
+# 日志配置
+# log_level: 低于这个级别的日志直接丢弃
+# log_per_worker: 为 True 时每个 gunicorn worker 写自己的 mylog.{pid}.txt，避免多个进程抢同一个文件
+# log_max_bytes / log_backup_count: 单个日志文件的大小上限和保留的旧文件个数
+# log_batch_size: 后台线程一次最多合并写入的日志条数
+# log_to_stdout_level: 达到这个级别的日志同时输出到 stdout，由 supervisor 收集
+log_path = 'mylog.txt'
+log_level = logging.INFO
+log_per_worker = False
+log_max_bytes = 10 * 1024 * 1024
+log_backup_count = 5
+log_batch_size = 200
+log_to_stdout_level = logging.WARNING
+
+# 缓存命中情况不再逐条写日志，每累计这么多次查询汇总写一条
+cache_stat_every = 1000
+# 每次 cache_stat 都会调用这里的函数 f(name, hit, n)，用于按请求统计命中率
+cache_stat_listeners = []
+
+logger = logging.getLogger('web_bbs')
+
+_writer = None
+_console = None
+_writer_lock = threading.Lock()
+_cache_stats = Counter()
+_cache_stats_lock = threading.Lock()
+
+
+class _BatchWriter(threading.Thread):
+    """
+    后台写日志的线程。
+    请求里的 log 只是把日志放进队列，这个线程一次取出队列中积压的多条日志，
+    合并成一次 write + flush，避免每条日志都打开、写入、关闭一次文件。
+    """
+
+    def __init__(self, q, handler):
+        super().__init__(name='log-writer', daemon=True)
+        self.queue = q
+        self.handler = handler
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            records = [self.queue.get()]
+            while len(records) < log_batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None 是 stop 放进来的结束标记，它前面的日志都要写完
+            if None in records:
+                stopped = True
+                records = records[:records.index(None)]
+            if records:
+                self.write(records)
+
+    def stop(self, timeout=5):
+        """进程退出时调用，等队列中剩下的日志写完，命令行脚本写完日志马上退出时不会丢"""
+        # gunicorn fork 出的 worker 也会继承父进程注册的 atexit，但线程不在这个进程里
+        if self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.join(timeout)
+
+    def write(self, records):
+        h = self.handler
+        h.acquire()
+        try:
+            for r in records:
+                if h.shouldRollover(r):
+                    h.doRollover()
+                h.stream.write(h.format(r) + h.terminator)
+            h.stream.flush()
+        except Exception:
+            h.handleError(records[-1])
+        finally:
+            h.release()
+
+
+def _file_path():
+    if log_per_worker:
+        name, ext = os.path.splitext(log_path)
+        return '{}.{}{}'.format(name, os.getpid(), ext)
+    return log_path
+
+
+def _setup():
+    """
+    第一次写日志时才初始化，按进程 id 记录。
+    gunicorn fork 出 worker 后，父进程里的写日志线程不会被带过来，需要在 worker 里重新初始化。
+    """
+    global _writer, _console
+    with _writer_lock:
+        if _writer is not None and _writer.pid == os.getpid():
+            return
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+
+        fmt = logging.Formatter('%(asctime)s %(process)d %(levelname)s %(message)s', '%H:%M:%S')
+        file_handler = RotatingFileHandler(
+            _file_path(), maxBytes=log_max_bytes, backupCount=log_backup_count, encoding='utf-8')
+        file_handler.setFormatter(fmt)
+
+        q = queue.Queue()
+        logger.addHandler(QueueHandler(q))
+        _console = logging.StreamHandler()
+        _console.setLevel(log_to_stdout_level)
+        _console.setFormatter(fmt)
+        logger.addHandler(_console)
+        logger.setLevel(log_level)
+        logger.propagate = False
+
+        _writer = _BatchWriter(q, file_handler)
+        _writer.pid = os.getpid()
+        _writer.start()
+        atexit.register(_writer.stop)
+
+
+def log_to_console(level=logging.INFO):
+    """
+    命令行脚本(migrate.py、search_index.py 等)在开始时调用，
+    达到 level 的日志同时输出到终端，运行时能看到进度。web 和后台 worker 只输出 WARNING 以上。
+    """
+    global log_to_stdout_level
+    log_to_stdout_level = level
+    if _console is not None:
+        _console.setLevel(level)
+
+
+def log(*args, level=logging.INFO):
+    """
+    写一条日志，参数用空格拼接，默认 INFO 级别。
+    日志先进队列，由后台线程批量写入文件，不阻塞请求。
+    """
+    if _writer is None or _writer.pid != os.getpid():
+        _setup()
+    if logger.isEnabledFor(level):
+        logger.log(level, ' '.join(str(a) for a in args))
+
+
+def write_file_atomic(path, data):
+    """先写临时文件再改名，nginx 和其他进程不会读到写了一半的文件"""
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def cache_stat(name, hit, n=1):
+    """
+    记录 n 次缓存查询，name 是缓存的种类，hit 表示是否命中。
+    只在内存中计数，每 cache_stat_every 次查询汇总写一条日志。
+    """
+    for f in cache_stat_listeners:
+        f(name, hit, n)
+    with _cache_stats_lock:
+        _cache_stats[(name, hit)] += n
+        _cache_stats['total'] += n
+        if _cache_stats['total'] < cache_stat_every:
+            return
+        stats = _cache_stats.copy()
+        _cache_stats.clear()
+
+    names = sorted({k[0] for k in stats if k != 'total'})
+    s = ', '.join('{} 命中{} 丢失{}'.format(k, stats[(k, True)], stats[(k, False)]) for k in names)
+    log('缓存统计', s)